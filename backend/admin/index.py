@@ -1,232 +1,758 @@
-import json
 import os
+import io
+import base64
+import hashlib
+import socket
+import ipaddress
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import boto3
+import requests
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from PIL import Image
+from http_api import api_handler, error_response, json_body, json_response
+from order_events import add_order_event
+from perf_sampling import profiled
 
+# Ширины нарезаемых вариантов изображений товаров
+IMAGE_WIDTHS = (320, 640, 1280)
+
+# Ширина варианта, который записывается в products.image_url
+IMAGE_DEFAULT_WIDTH = 640
+
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg')
+}
+
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', str(10 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', str(40_000_000)))
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+# Локальный каталог вместо S3 (для разработки и тестов)
+IMAGE_STORAGE_DIR = os.environ.get('IMAGE_STORAGE_DIR', '')
+IMAGE_PUBLIC_URL = os.environ.get('IMAGE_PUBLIC_URL', '')
+
+# Минимальная аренда событий в claim_events (секунды)
+EVENT_MIN_LEASE_SECONDS = 5
+
+_image_pool = None
+_s3_client = None
+
+@profiled('admin')
+@api_handler('admin', ('GET', 'POST', 'PUT', 'PATCH'))
 def handler(event: dict, context) -> dict:
     """API для админ-панели: управление товарами и заказами"""
     
     method = event.get('httpMethod', 'GET')
     path_params = event.get('pathParams') or {}
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, PATCH, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    db_url = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    try:
-        db_url = os.environ.get('DATABASE_URL')
-        conn = psycopg2.connect(db_url)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        query_params = event.get('queryStringParameters') or {}
-        action = query_params.get('action', '')
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', '')
+    
+    if method == 'GET':
+        if action == 'products':
+            cur.execute(
+                """
+                SELECT p.*, c.name as category_name, c.slug as category_slug,
+                       COALESCE((
+                           SELECT json_agg(
+                                      json_build_object(
+                                          'format', pi.format,
+                                          'width', pi.width,
+                                          'url', pi.url
+                                      ) ORDER BY pi.width, pi.format
+                                  )
+                           FROM product_images pi
+                           WHERE pi.product_id = p.id
+                       ), '[]') as images,
+                       ps.capacity as stock_capacity, ps.remaining as stock_remaining
+                FROM products p
+                LEFT JOIN categories c ON p.category_id = c.id
+                LEFT JOIN product_stock ps ON ps.product_id = p.id AND ps.stock_date = CURRENT_DATE
+                ORDER BY p.created_at DESC
+                """
+            )
+            products = cur.fetchall()
+            
+            result = []
+            for p in products:
+                product = dict(p)
+                product['price'] = float(product['price'])
+                product['created_at'] = product['created_at'].isoformat() if product['created_at'] else None
+                product['updated_at'] = product['updated_at'].isoformat() if product['updated_at'] else None
+                result.append(product)
+            
+            return json_response({'products': result})
         
-        if method == 'GET':
-            if action == 'products':
+        elif action == 'orders':
+            status_filter = query_params.get('status', '')
+            
+            if status_filter:
                 cur.execute(
                     """
-                    SELECT p.*, c.name as category_name, c.slug as category_slug
-                    FROM products p
-                    LEFT JOIN categories c ON p.category_id = c.id
-                    ORDER BY p.created_at DESC
+                    SELECT o.*, 
+                           json_agg(
+                               json_build_object(
+                                   'id', oi.id,
+                                   'product_name', oi.product_name,
+                                   'product_price', oi.product_price,
+                                   'quantity', oi.quantity,
+                                   'subtotal', oi.subtotal
+                               )
+                           ) as items
+                    FROM orders o
+                    LEFT JOIN order_items oi ON o.id = oi.order_id
+                    WHERE o.status = %s
+                    GROUP BY o.id
+                    ORDER BY o.created_at DESC
+                    """,
+                    (status_filter,)
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT o.*, 
+                           json_agg(
+                               json_build_object(
+                                   'id', oi.id,
+                                   'product_name', oi.product_name,
+                                   'product_price', oi.product_price,
+                                   'quantity', oi.quantity,
+                                   'subtotal', oi.subtotal
+                               )
+                           ) as items
+                    FROM orders o
+                    LEFT JOIN order_items oi ON o.id = oi.order_id
+                    GROUP BY o.id
+                    ORDER BY o.created_at DESC
                     """
                 )
-                products = cur.fetchall()
-                
-                result = []
-                for p in products:
-                    product = dict(p)
-                    product['price'] = float(product['price'])
-                    product['created_at'] = product['created_at'].isoformat() if product['created_at'] else None
-                    product['updated_at'] = product['updated_at'].isoformat() if product['updated_at'] else None
-                    result.append(product)
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'products': result}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'orders':
-                status_filter = query_params.get('status', '')
-                
-                if status_filter:
-                    cur.execute(
-                        """
-                        SELECT o.*, 
-                               json_agg(
-                                   json_build_object(
-                                       'id', oi.id,
-                                       'product_name', oi.product_name,
-                                       'product_price', oi.product_price,
-                                       'quantity', oi.quantity,
-                                       'subtotal', oi.subtotal
-                                   )
-                               ) as items
-                        FROM orders o
-                        LEFT JOIN order_items oi ON o.id = oi.order_id
-                        WHERE o.status = %s
-                        GROUP BY o.id
-                        ORDER BY o.created_at DESC
-                        """,
-                        (status_filter,)
-                    )
-                else:
-                    cur.execute(
-                        """
-                        SELECT o.*, 
-                               json_agg(
-                                   json_build_object(
-                                       'id', oi.id,
-                                       'product_name', oi.product_name,
-                                       'product_price', oi.product_price,
-                                       'quantity', oi.quantity,
-                                       'subtotal', oi.subtotal
-                                   )
-                               ) as items
-                        FROM orders o
-                        LEFT JOIN order_items oi ON o.id = oi.order_id
-                        GROUP BY o.id
-                        ORDER BY o.created_at DESC
-                        """
-                    )
-                
-                orders = cur.fetchall()
-                
-                result = []
-                for order in orders:
-                    order_dict = dict(order)
-                    order_dict['created_at'] = order_dict['created_at'].isoformat() if order_dict['created_at'] else None
-                    order_dict['updated_at'] = order_dict['updated_at'].isoformat() if order_dict['updated_at'] else None
-                    order_dict['total_amount'] = float(order_dict['total_amount'])
-                    
-                    if order_dict['items']:
-                        for item in order_dict['items']:
-                            if item:
-                                item['product_price'] = float(item['product_price'])
-                                item['subtotal'] = float(item['subtotal'])
-                    
-                    result.append(order_dict)
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'orders': result}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'categories':
-                cur.execute("SELECT * FROM categories ORDER BY name")
-                categories = cur.fetchall()
+            
+            orders = cur.fetchall()
+            
+            result = []
+            for order in orders:
+                order_dict = dict(order)
+                order_dict['created_at'] = order_dict['created_at'].isoformat() if order_dict['created_at'] else None
+                order_dict['updated_at'] = order_dict['updated_at'].isoformat() if order_dict['updated_at'] else None
+                order_dict['total_amount'] = float(order_dict['total_amount'])
                 
-                result = []
-                for cat in categories:
-                    cat_dict = dict(cat)
-                    cat_dict['created_at'] = cat_dict['created_at'].isoformat() if cat_dict.get('created_at') else None
-                    result.append(cat_dict)
+                if order_dict['items']:
+                    for item in order_dict['items']:
+                        if item:
+                            item['product_price'] = float(item['product_price'])
+                            item['subtotal'] = float(item['subtotal'])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'categories': result}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
+                result.append(order_dict)
+            
+            return json_response({'orders': result})
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
+        elif action == 'categories':
+            cur.execute("SELECT * FROM categories ORDER BY name")
+            categories = cur.fetchall()
             
-            if action == 'product':
-                cur.execute(
-                    """
-                    INSERT INTO products (name, description, price, category_id, image_url, is_available)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                    """,
-                    (body.get('name'), body.get('description'), body.get('price'),
-                     body.get('category_id'), body.get('image_url'), body.get('is_available', True))
-                )
-                result = cur.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'id': result['id'], 'message': 'Товар создан'}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
+            result = []
+            for cat in categories:
+                cat_dict = dict(cat)
+                cat_dict['created_at'] = cat_dict['created_at'].isoformat() if cat_dict.get('created_at') else None
+                result.append(cat_dict)
+            
+            return json_response({'categories': result})
         
-        elif method in ['PUT', 'PATCH']:
-            body = json.loads(event.get('body', '{}'))
+        elif action == 'perf':
+            hours = query_params.get('hours', '24')
             
-            if action == 'product':
-                product_id = body.get('id')
-                
-                cur.execute(
-                    """
-                    UPDATE products 
-                    SET name = %s, description = %s, price = %s, 
-                        category_id = %s, image_url = %s, is_available = %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                    """,
-                    (body.get('name'), body.get('description'), body.get('price'),
-                     body.get('category_id'), body.get('image_url'), body.get('is_available'),
-                     product_id)
+            if not hours.isdigit() or int(hours) < 1:
+                return error_response(400, 'hours должно быть целым числом больше нуля')
+            hours = int(hours)
+            
+            # Перцентили только по выборке каждого PERF_TIMING_EVERY-го запроса без профиля: медленные
+            # запросы их бы завысили, а cProfile замедляет сам запрос. Без PERF_TIMING_EVERY sampled = 0 и перцентили null
+            cur.execute(
+                """
+                SELECT handler, action,
+                       COUNT(*) as samples,
+                       COUNT(*) FILTER (WHERE sampled AND NOT profiled) as sampled,
+                       COUNT(*) FILTER (WHERE is_slow) as slow,
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_ms) FILTER (WHERE sampled AND NOT profiled) as p50_ms,
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms) FILTER (WHERE sampled AND NOT profiled) as p95_ms,
+                       percentile_cont(0.99) WITHIN GROUP (ORDER BY duration_ms) FILTER (WHERE sampled AND NOT profiled) as p99_ms,
+                       MAX(duration_ms) as max_ms,
+                       AVG(sql_ms) as avg_sql_ms,
+                       AVG(response_bytes) as avg_response_bytes
+                FROM perf_samples
+                WHERE created_at > CURRENT_TIMESTAMP - make_interval(hours => %s)
+                GROUP BY handler, action
+                ORDER BY max_ms DESC
+                """,
+                (hours,)
+            )
+            stats = cur.fetchall()
+            
+            cur.execute(
+                """
+                SELECT handler, action, method, status_code, duration_ms, sql_calls, sql_ms,
+                       request_bytes, response_bytes, top_functions, created_at
+                FROM perf_samples
+                WHERE created_at > CURRENT_TIMESTAMP - make_interval(hours => %s) AND top_functions IS NOT NULL
+                ORDER BY duration_ms DESC
+                LIMIT 5
+                """,
+                (hours,)
+            )
+            slowest = cur.fetchall()
+            
+            result = []
+            for row in stats:
+                row_dict = dict(row)
+                for key in ['p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'avg_sql_ms', 'avg_response_bytes']:
+                    row_dict[key] = round(float(row_dict[key]), 2) if row_dict[key] is not None else None
+                result.append(row_dict)
+            
+            slowest_result = []
+            for row in slowest:
+                row_dict = dict(row)
+                row_dict['created_at'] = row_dict['created_at'].isoformat() if row_dict['created_at'] else None
+                slowest_result.append(row_dict)
+            
+            return json_response({'handlers': result, 'slowest': slowest_result})
+    
+    elif method == 'POST':
+        body = json_body(event)
+        
+        if action == 'product':
+            image = None
+            if body.get('image_url') or body.get('image_data'):
+                # Скачивание и нарезка идут без соединения с базой, запись — одной короткой транзакцией
+                conn.close()
+                try:
+                    image = prepare_product_image(body.get('image_url'), body.get('image_data'))
+                except ValueError as e:
+                    return error_response(400, f'Не удалось обработать изображение: {str(e)}')
+                conn = psycopg2.connect(db_url)
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            cur.execute(
+                """
+                INSERT INTO products (name, description, price, category_id, image_url, is_available)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+                """,
+                (body.get('name'), body.get('description'), body.get('price'),
+                 body.get('category_id'), body.get('image_url'), body.get('is_available', True))
+            )
+            result = cur.fetchone()
+            
+            if image:
+                save_product_images(cur, result['id'], image)
+            
+            conn.commit()
+            
+            return json_response({'id': result['id'], 'message': 'Товар создан'})
+        
+        elif action == 'backfill_images':
+            # Разовая нарезка товаров, у которых только внешняя ссылка (сиды); повторять с next_after_id до done
+            try:
+                after_id = max(int(body.get('after_id', 0)), 0)
+                limit = min(max(int(body.get('limit', 10)), 1), 50)
+            except (TypeError, ValueError):
+                return error_response(400, 'after_id и limit должны быть числами')
+            
+            cur.execute(
+                """
+                SELECT p.id, p.image_url
+                FROM products p
+                WHERE p.id > %s AND COALESCE(p.image_url, '') <> ''
+                  AND NOT EXISTS (SELECT 1 FROM product_images pi WHERE pi.product_id = p.id)
+                ORDER BY p.id
+                LIMIT %s
+                """,
+                (after_id, limit)
+            )
+            products = cur.fetchall()
+            conn.commit()
+            conn.close()
+            
+            images = {}
+            failed = []
+            for product in products:
+                try:
+                    images[product['id']] = prepare_product_image(product['image_url'], None)
+                except ValueError as e:
+                    failed.append({'id': product['id'], 'error': str(e)})
+            
+            conn = psycopg2.connect(db_url)
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            for product_id, image in images.items():
+                save_product_images(cur, product_id, image)
+            conn.commit()
+            
+            return json_response({
+                'processed': len(images),
+                'failed': failed,
+                'next_after_id': products[-1]['id'] if products else after_id,
+                'done': len(products) < limit
+            })
+        
+        elif action == 'claim_events':
+            consumer_group = body.get('consumer_group', '')
+            consumer = body.get('consumer', '')
+            
+            if not consumer_group or not consumer:
+                return error_response(400, 'Не указаны consumer_group и consumer')
+            
+            # Аренда короче EVENT_MIN_LEASE_SECONDS позволила бы сразу забирать события, которые ещё обрабатываются
+            try:
+                lease_seconds = min(max(int(body.get('lease_seconds', 60)), EVENT_MIN_LEASE_SECONDS), 3600)
+                limit = min(max(int(body.get('limit', 100)), 1), 1000)
+            except (TypeError, ValueError):
+                return error_response(400, 'lease_seconds и limit должны быть числами')
+            
+            # Группа получает события, записанные после её первого обращения
+            cur.execute(
+                "INSERT INTO order_event_consumer_groups (consumer_group) VALUES (%s) ON CONFLICT DO NOTHING",
+                (consumer_group,)
+            )
+            
+            cur.execute(
+                """
+                WITH claimed AS (
+                    UPDATE order_event_deliveries
+                    SET claimed_by = %s, claimed_at = CURRENT_TIMESTAMP
+                    WHERE consumer_group = %s AND event_id IN (
+                        SELECT event_id
+                        FROM order_event_deliveries
+                        WHERE consumer_group = %s
+                          AND processed_at IS NULL
+                          AND (claimed_at IS NULL OR claimed_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                        ORDER BY event_id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING event_id
                 )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': 'Товар обновлён'}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
-            
-            elif action == 'order_status':
-                order_id = body.get('order_id')
-                new_status = body.get('status')
-                
-                cur.execute(
-                    """
-                    UPDATE orders 
-                    SET status = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                    """,
-                    (new_status, order_id)
+                SELECT e.id, e.order_id, e.event_type, e.payload, e.created_at
+                FROM order_events e
+                JOIN claimed c ON c.event_id = e.id
+                ORDER BY e.id
+                """,
+                (consumer, consumer_group, consumer_group, lease_seconds, limit)
+            )
+            events = cur.fetchall()
+            conn.commit()
+            
+            result = []
+            for event_row in events:
+                event_dict = dict(event_row)
+                event_dict['created_at'] = event_dict['created_at'].isoformat() if event_dict['created_at'] else None
+                result.append(event_dict)
+            
+            return json_response({'events': result})
+        
+        elif action == 'ack_events':
+            event_ids = body.get('event_ids', [])
+            if not isinstance(event_ids, list) or not all(isinstance(event_id, int) for event_id in event_ids):
+                return error_response(400, 'event_ids должен быть списком чисел')
+            
+            cur.execute(
+                """
+                UPDATE order_event_deliveries
+                SET processed_at = CURRENT_TIMESTAMP
+                WHERE consumer_group = %s AND event_id = ANY(%s)
+                  AND claimed_by = %s AND processed_at IS NULL
+                """,
+                (body.get('consumer_group', ''), event_ids, body.get('consumer', ''))
+            )
+            acknowledged = cur.rowcount
+            conn.commit()
+            
+            return json_response({'acknowledged': acknowledged})
+    
+    elif method in ['PUT', 'PATCH']:
+        body = json_body(event)
+        
+        if action == 'product':
+            product_id = body.get('id')
+            
+            # Товары без вариантов (например, из сидов с внешними ссылками) нарезаются при любом сохранении
+            cur.execute(
+                """
+                SELECT image_url, EXISTS (SELECT 1 FROM product_images pi WHERE pi.product_id = p.id) as has_images
+                FROM products p
+                WHERE id = %s
+                """,
+                (product_id,)
+            )
+            current = cur.fetchone()
+            conn.commit()
+            image_changed = body.get('image_data') or (
+                body.get('image_url') and (
+                    not current or body.get('image_url') != current['image_url'] or not current['has_images']
                 )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': 'Статус заказа обновлён'}, ensure_ascii=False),
-                    'isBase64Encoded': False
-                }
+            )
+            
+            image = None
+            if image_changed:
+                conn.close()
+                try:
+                    image = prepare_product_image(body.get('image_url'), body.get('image_data'))
+                except ValueError as e:
+                    return error_response(400, f'Не удалось обработать изображение: {str(e)}')
+                conn = psycopg2.connect(db_url)
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            cur.execute(
+                """
+                UPDATE products 
+                SET name = %s, description = %s, price = %s, 
+                    category_id = %s, image_url = %s, is_available = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                """,
+                (body.get('name'), body.get('description'), body.get('price'),
+                 body.get('category_id'), body.get('image_url'), body.get('is_available'),
+                 product_id)
+            )
+            
+            if image:
+                save_product_images(cur, product_id, image)
+            
+            conn.commit()
+            
+            return json_response({'message': 'Товар обновлён'})
         
-        cur.close()
-        conn.close()
+        elif action == 'order_status':
+            order_id = body.get('order_id')
+            new_status = body.get('status')
+            
+            cur.execute(
+                """
+                UPDATE orders 
+                SET status = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND status IS DISTINCT FROM %s
+                RETURNING id
+                """,
+                (new_status, order_id, new_status)
+            )
+            if cur.fetchone():
+                if new_status == 'cancelled':
+                    release_stock(cur, order_id)
+                elif not reserve_released_stock(cur, order_id):
+                    conn.rollback()
+                    return error_response(409, 'Недостаточно товара, чтобы вернуть заказ из отмены')
+                add_order_event(cur, order_id, 'status_changed', {'status': new_status})
+            conn.commit()
+            
+            return json_response({'message': 'Статус заказа обновлён'})
         
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Неверные параметры запроса'}),
-            'isBase64Encoded': False
-        }
+        elif action == 'stock':
+            product_id = body.get('product_id')
+            capacity = body.get('capacity')
+            
+            if not product_id or not isinstance(capacity, int) or capacity < 0:
+                return error_response(400, 'Укажите product_id и capacity')
+            
+            cur.execute(
+                """
+                INSERT INTO product_stock (product_id, stock_date, capacity, remaining)
+                VALUES (%s, COALESCE(%s::date, CURRENT_DATE), %s, %s)
+                ON CONFLICT (product_id, stock_date) DO UPDATE
+                SET remaining = GREATEST(product_stock.remaining + EXCLUDED.capacity - product_stock.capacity, 0),
+                    capacity = EXCLUDED.capacity,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING product_id, stock_date, capacity, remaining
+                """,
+                (product_id, body.get('stock_date'), capacity, capacity)
+            )
+            stock = dict(cur.fetchone())
+            conn.commit()
+            
+            stock['stock_date'] = stock['stock_date'].isoformat()
+            
+            return json_response({'stock': stock, 'message': 'Остаток обновлён'})
+    
+    cur.close()
+    conn.close()
+    
+    return error_response(400, 'Неверные параметры запроса')
+
+
+def release_stock(cur, order_id: int):
+    """Возврат зарезервированных позиций отменённого заказа в остаток.
+    
+    Флаг stock_released_at ставится в том же UPDATE, что и проверяется, поэтому резерв возвращается один раз.
+    """
+    
+    cur.execute(
+        """
+        UPDATE orders
+        SET stock_released_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND stock_released_at IS NULL
+        RETURNING id
+        """,
+        (order_id,)
+    )
+    if not cur.fetchone():
+        return
+    
+    cur.execute(
+        """
+        UPDATE product_stock ps
+        SET remaining = LEAST(ps.remaining + r.quantity, ps.capacity),
+            updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT product_id, stock_date, SUM(quantity) as quantity
+            FROM order_items
+            WHERE order_id = %s AND stock_date IS NOT NULL
+            GROUP BY product_id, stock_date
+        ) r
+        WHERE ps.product_id = r.product_id AND ps.stock_date = r.stock_date
+        """,
+        (order_id,)
+    )
+
+
+def reserve_released_stock(cur, order_id: int) -> bool:
+    """Повторный резерв позиций заказа, который вернули из отмены; False, если остатка уже не хватает"""
+    
+    cur.execute(
+        """
+        UPDATE orders
+        SET stock_released_at = NULL
+        WHERE id = %s AND stock_released_at IS NOT NULL
+        RETURNING id
+        """,
+        (order_id,)
+    )
+    if not cur.fetchone():
+        return True
+    
+    cur.execute(
+        """
+        SELECT product_id, stock_date, SUM(quantity) as quantity
+        FROM order_items
+        WHERE order_id = %s AND stock_date IS NOT NULL
+        GROUP BY product_id, stock_date
+        ORDER BY product_id
+        """,
+        (order_id,)
+    )
+    for item in cur.fetchall():
+        cur.execute(
+            """
+            UPDATE product_stock
+            SET remaining = remaining - %s, updated_at = CURRENT_TIMESTAMP
+            WHERE product_id = %s AND stock_date = %s AND remaining >= %s
+            RETURNING product_id
+            """,
+            (item['quantity'], item['product_id'], item['stock_date'], item['quantity'])
+        )
+        if not cur.fetchone():
+            return False
+    
+    return True
+
+
+def prepare_product_image(image_url: str, image_data: str) -> dict:
+    """Загрузка исходного изображения, нарезка вариантов и сохранение их в хранилище.
+    
+    Работает без базы: скачивание и нарезка долгие, транзакцию на это время не держим.
+    Ошибки загрузки и декодирования исходника поднимаются как ValueError.
+    """
+    
+    if image_data:
+        try:
+            source = base64.b64decode(image_data.split(',', 1)[-1], validate=True)
+        except ValueError:
+            raise ValueError('image_data не является base64')
+        if len(source) > IMAGE_MAX_BYTES:
+            raise ValueError('изображение слишком большое')
+        source_url = None
+    else:
+        source = fetch_image(image_url)
+        source_url = image_url
+    
+    try:
+        source_width, source_height = Image.open(io.BytesIO(source)).size
+    except (OSError, Image.DecompressionBombError):
+        raise ValueError('файл не является изображением')
+    if source_width * source_height > IMAGE_MAX_PIXELS:
+        raise ValueError('слишком большое разрешение изображения')
+    
+    content_hash = hashlib.sha256(source).hexdigest()
+    
+    # Варианты шире исходника не делаем: вместо них один вариант в исходной ширине
+    widths = sorted({min(width, source_width) for width in IMAGE_WIDTHS})
+    default_width = min(IMAGE_DEFAULT_WIDTH, source_width)
+    
+    images = []
+    default_url = None
+    for image_format, width, data in resize_variants(source, widths):
+        key = f'products/{content_hash[:16]}-{width}.{image_format}'
+        url = store_image(key, data, IMAGE_FORMATS[image_format][1])
+        images.append((image_format, width, url))
         
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        if image_format == 'jpeg' and width == default_width:
+            default_url = url
+    
+    return {'source_url': source_url, 'content_hash': content_hash, 'images': images, 'default_url': default_url}
+
+
+def save_product_images(cur, product_id: int, image: dict):
+    """Запись подготовленных вариантов в product_images и варианта по умолчанию в products в текущей транзакции"""
+    
+    cur.execute("DELETE FROM product_images WHERE product_id = %s", (product_id,))
+    execute_values(
+        cur,
+        "INSERT INTO product_images (product_id, source_url, content_hash, format, width, url) VALUES %s",
+        [(product_id, image['source_url'], image['content_hash'], image_format, width, url)
+         for image_format, width, url in image['images']]
+    )
+    cur.execute(
+        "UPDATE products SET image_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (image['default_url'], product_id)
+    )
+
+
+def resize_variants(source: bytes, widths: list) -> list:
+    """Нарезка всех ширин в пуле процессов.
+    
+    Если воркер убит (например, по памяти), пул сломан навсегда: пересоздаём его и пробуем ещё раз,
+    а повторное падение считаем ошибкой исходника.
+    """
+    
+    global _image_pool
+    for _ in range(2):
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(max_workers=int(os.environ.get('IMAGE_WORKERS', '2')))
+        try:
+            return [variant for width_variants in _image_pool.map(resize_image, [(source, width) for width in widths])
+                    for variant in width_variants]
+        except BrokenProcessPool:
+            _image_pool.shutdown(wait=False)
+            _image_pool = None
+    
+    raise ValueError('обработка изображения прервана: воркеру не хватило ресурсов')
+
+
+def fetch_image(image_url: str) -> bytes:
+    """Скачивание исходника по http(s) только с публичных адресов и не больше IMAGE_MAX_BYTES"""
+    
+    for _ in range(4):
+        check_public_url(image_url)
+        
+        try:
+            response = requests.get(image_url, timeout=15, stream=True, allow_redirects=False)
+        except requests.RequestException as e:
+            raise ValueError(f'не удалось скачать изображение: {str(e)}')
+        
+        with response:
+            if response.is_redirect:
+                image_url = urljoin(image_url, response.headers.get('Location', ''))
+                continue
+            
+            if response.status_code != 200:
+                raise ValueError(f'источник изображения вернул {response.status_code}')
+            
+            if int(response.headers.get('Content-Length') or 0) > IMAGE_MAX_BYTES:
+                raise ValueError('изображение слишком большое')
+            
+            chunks = []
+            size = 0
+            try:
+                for chunk in response.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size > IMAGE_MAX_BYTES:
+                        raise ValueError('изображение слишком большое')
+                    chunks.append(chunk)
+            except requests.RequestException as e:
+                raise ValueError(f'не удалось скачать изображение: {str(e)}')
+            
+            return b''.join(chunks)
+    
+    raise ValueError('слишком много перенаправлений')
+
+
+def check_public_url(image_url: str):
+    """Запрет схем кроме http(s) и адресов локальной сети, чтобы сервер не ходил во внутренние сервисы"""
+    
+    parsed = urlparse(image_url or '')
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError('изображение можно загрузить только по http(s)')
+    
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f'не удалось найти хост {parsed.hostname}')
+    
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%', 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError('загрузка изображений с внутренних адресов запрещена')
+
+
+def resize_image(job: tuple) -> list:
+    """Уменьшение изображения до заданной ширины и кодирование во все форматы (выполняется в пуле процессов)"""
+    
+    source, width = job
+    
+    try:
+        image = Image.open(io.BytesIO(source))
+        if image.width > width:
+            # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8), не меньше нужной ширины
+            image.draft('RGB', (width, round(image.height * width / image.width)))
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f'не удалось декодировать изображение: {str(e)}')
+    
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.LANCZOS)
+    
+    result = []
+    for image_format, (pil_format, _) in IMAGE_FORMATS.items():
+        output = image
+        if has_alpha and pil_format == 'JPEG':
+            # JPEG без прозрачности: подкладываем белый фон вместо чёрного
+            output = Image.new('RGB', image.size, (255, 255, 255))
+            output.paste(image, mask=image.getchannel('A'))
+        
+        buffer = io.BytesIO()
+        output.save(buffer, pil_format, quality=82, optimize=True)
+        result.append((image_format, image.width, buffer.getvalue()))
+    
+    return result
+
+
+def store_image(key: str, data: bytes, content_type: str) -> str:
+    """Сохранение варианта изображения в S3 или локальный каталог, возвращает публичный URL"""
+    
+    if IMAGE_STORAGE_DIR:
+        path = os.path.join(IMAGE_STORAGE_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return f'{IMAGE_PUBLIC_URL.rstrip("/")}/{key}' if IMAGE_PUBLIC_URL else f'file://{path}'
+    
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
+            's3',
+            endpoint_url='https://bucket.poehali.dev',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    _s3_client.put_object(Bucket='files', Key=key, Body=data, ContentType=content_type)
+    
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
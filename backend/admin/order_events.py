@@ -0,0 +1,40 @@
+"""Запись событий заказов для потребителей (admin action=claim_events / ack_events).
+
+Исходник лежит в backend/_shared, копии в каталогах функций обновляет scripts/sync_shared.py.
+
+Событие пишется в order_events в транзакции, которая меняет заказ, и сразу раздаётся
+всем зарегистрированным группам потребителей строками order_event_deliveries.
+"""
+
+import json
+
+from psycopg2.extras import execute_values
+
+
+def add_order_event(cur, order_id: int, event_type: str, payload: dict):
+    """Запись одного события заказа и доставок для всех групп потребителей в текущей транзакции"""
+    
+    add_order_events(cur, [(order_id, event_type, payload)])
+
+
+def add_order_events(cur, events: list):
+    """Запись пачки событий (order_id, event_type, payload) одним запросом в текущей транзакции"""
+    
+    if not events:
+        return
+    
+    execute_values(
+        cur,
+        """
+        WITH events AS (
+            INSERT INTO order_events (order_id, event_type, payload)
+            VALUES %s
+            RETURNING id
+        )
+        INSERT INTO order_event_deliveries (consumer_group, event_id)
+        SELECT g.consumer_group, events.id
+        FROM order_event_consumer_groups g, events
+        """,
+        [(order_id, event_type, json.dumps(payload, ensure_ascii=False)) for order_id, event_type, payload in events],
+        page_size=len(events)
+    )
@@ -0,0 +1,150 @@
+"""Локальный dev-сервер: все функции из func2url.json на одном порту.
+
+CORS, разбор JSON, перевод ошибок в статусы и хуки времени делает общий слой
+http_api (backend/_shared, копии в каталогах функций синхронизирует
+scripts/sync_shared.py). Сервер передаёт запрос в handler(event, context) без
+изменений и подключает к http_api свои хуки: заголовок Server-Timing и строку лога.
+Модули из backend/_shared стоят первыми в sys.path, поэтому здесь функции работают
+с исходником, а не со своими копиями; расхождение копий ловит sync_shared.py --check.
+
+Запуск:  DATABASE_URL=postgresql://... python backend/devserver.py --port 8000
+Функция доступна по адресу http://localhost:8000/<имя функции>/?...
+Для нагрузочных тестов можно поднять приложение через любой WSGI-сервер:
+gunicorn --chdir backend -w 4 devserver:app
+"""
+
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import sys
+import uuid
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+from wsgiref.simple_server import WSGIServer, make_server
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIR = os.path.join(BACKEND_DIR, '_shared')
+
+sys.path.insert(0, SHARED_DIR)
+
+import http_api  # noqa: E402
+
+HTTP_REASONS = {
+    200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error'
+}
+
+def add_server_timing(function_name: str, event: dict, response: dict, elapsed_ms: float):
+    """Хук: время handler в заголовке Server-Timing"""
+
+    response.setdefault('headers', {})['Server-Timing'] = f'handler;dur={elapsed_ms:.1f}'
+
+
+def log_timing(function_name: str, event: dict, response: dict, elapsed_ms: float):
+    """Хук по умолчанию: строка лога на каждый запрос"""
+
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    print(f"{event['httpMethod']} /{function_name}/ {action} -> {response.get('statusCode')} ({elapsed_ms:.1f} ms)")
+
+
+def load_function(name: str):
+    """Импорт index.py функции как отдельного модуля.
+
+    Модуль регистрируется в sys.modules, иначе pickle (пул процессов в admin) не найдёт его функции.
+    """
+
+    path = os.path.join(BACKEND_DIR, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f"function_{name.replace('-', '_')}", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_handlers() -> dict:
+    """Импорт handler каждой функции из func2url.json"""
+
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        function_names = json.load(f).keys()
+
+    if add_server_timing not in http_api.timing_hooks:
+        http_api.timing_hooks.append(add_server_timing)
+
+    return {name: load_function(name).handler for name in function_names}
+
+
+def build_event(environ: dict, path: str) -> dict:
+    """Событие в формате облачной функции из WSGI environ"""
+
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers[key[5:].replace('_', '-').title()] = value
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length).decode('utf-8') if length else ''
+
+    return {
+        'httpMethod': environ['REQUEST_METHOD'],
+        'path': path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(environ.get('QUERY_STRING', ''))),
+        'pathParams': {},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+handlers = {}
+
+
+def app(environ: dict, start_response):
+    """WSGI-приложение: /<имя функции>/... -> handler этой функции"""
+
+    if not handlers:
+        handlers.update(load_handlers())
+
+    function_name, _, rest = environ.get('PATH_INFO', '/').lstrip('/').partition('/')
+    handler = handlers.get(function_name)
+
+    if handler is None:
+        response = http_api.error_response(404, f'Функция {function_name} не найдена')
+    else:
+        event = build_event(environ, '/' + rest)
+        context = SimpleNamespace(request_id=str(uuid.uuid4()), function_name=function_name)
+        response = handler(event, context)
+
+    body = response.get('body') or ''
+    body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+
+    status = response.get('statusCode', 200)
+    start_response(
+        f"{status} {HTTP_REASONS.get(status, '')}".strip(),
+        [(k, str(v)) for k, v in response['headers'].items()]
+    )
+    return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальный сервер для всех облачных функций')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--quiet', action='store_true', help='не логировать время ответа')
+    args = parser.parse_args()
+
+    if not args.quiet:
+        http_api.timing_hooks.append(log_timing)
+
+    handlers.update(load_handlers())
+    server = make_server(args.host, args.port, app, server_class=ThreadingWSGIServer)
+    print(f"Функции {', '.join(handlers)} доступны на http://{args.host}:{args.port}/<функция>/")
+    server.serve_forever()
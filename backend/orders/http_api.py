@@ -0,0 +1,103 @@
+"""Общий HTTP-слой облачных функций: CORS и preflight, разбор JSON-тела, JSON-ответы,
+перевод ошибок в статусы и хуки времени ответа.
+
+Исходник лежит в backend/_shared. Функция деплоится только со своим каталогом, поэтому
+scripts/sync_shared.py копирует модуль в каталог каждой функции, а с --check проверяет,
+что копии не разошлись с исходником. Копии в каталогах функций руками не правятся.
+"""
+
+import functools
+import json
+import time
+
+# Хуки вызываются после каждого запроса: hook(function_name, event, response, elapsed_ms)
+timing_hooks = []
+
+
+class HttpError(Exception):
+    """Ошибка запроса, которая отдаётся клиенту как {'error': message} с заданным статусом"""
+    
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def json_response(data, status_code: int = 200) -> dict:
+    """Ответ функции с JSON-телом и CORS-заголовком"""
+    
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(data, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def error_response(status_code: int, message: str) -> dict:
+    """JSON-ответ с ошибкой"""
+    
+    return json_response({'error': message}, status_code)
+
+
+def json_body(event: dict) -> dict:
+    """Тело запроса как dict; HttpError 400, если это не JSON-объект"""
+    
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        raise HttpError(400, 'Тело запроса не является JSON')
+    
+    if not isinstance(body, dict):
+        raise HttpError(400, 'Тело запроса должно быть JSON-объектом')
+    
+    return body
+
+
+def api_handler(function_name: str, methods: tuple):
+    """Обёртка handler(event, context) с той же сигнатурой.
+    
+    OPTIONS получает CORS preflight, методы не из methods — 405. HttpError превращается
+    в ответ со своим статусом, любое другое исключение — в 500. После ответа вызываются timing_hooks.
+    """
+    
+    preflight = {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': ', '.join(methods + ('OPTIONS',)),
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+    
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapped(event: dict, context) -> dict:
+            started_at = time.perf_counter()
+            method = event.get('httpMethod', 'GET')
+            
+            if method == 'OPTIONS':
+                response = dict(preflight, headers=dict(preflight['headers']))
+            elif method not in methods:
+                response = error_response(405, 'Метод не поддерживается')
+            else:
+                try:
+                    response = handler(event, context)
+                except HttpError as e:
+                    response = error_response(e.status_code, e.message)
+                except Exception as e:
+                    response = error_response(500, f'Ошибка сервера: {str(e)}')
+            
+            if timing_hooks:
+                elapsed_ms = (time.perf_counter() - started_at) * 1000
+                for hook in timing_hooks:
+                    hook(function_name, event, response, elapsed_ms)
+            
+            return response
+        
+        return wrapped
+    
+    return decorator
@@ -1,4 +1,3 @@
-import json
 import os
 import smtplib
 from email.mime.text import MIMEText
@@ -6,105 +5,125 @@ from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from http_api import api_handler, error_response, json_body, json_response
+from order_events import add_order_event
+from perf_sampling import profiled
 
+@profiled('orders')
+@api_handler('orders', ('POST',))
 def handler(event: dict, context) -> dict:
     """API для приёма и обработки заказов из кондитерской"""
     
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method == 'POST':
-        try:
-            body = json.loads(event.get('body', '{}'))
-            
-            customer_name = body.get('customer_name', '')
-            customer_phone = body.get('customer_phone', '')
-            customer_email = body.get('customer_email', '')
-            delivery_method = body.get('delivery_method', 'pickup')
-            delivery_address = body.get('delivery_address', '')
-            comments = body.get('comments', '')
-            items = body.get('items', [])
-            total_amount = body.get('total_amount', 0)
-            
-            if not customer_name or not customer_phone or not items:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Не заполнены обязательные поля'}),
-                    'isBase64Encoded': False
-                }
-            
-            db_url = os.environ.get('DATABASE_URL')
-            conn = psycopg2.connect(db_url)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cur.execute(
-                """
-                INSERT INTO orders (customer_name, customer_phone, customer_email, 
-                                    delivery_method, delivery_address, comments, total_amount, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-                """,
-                (customer_name, customer_phone, customer_email, 
-                 delivery_method, delivery_address, comments, total_amount, 'new')
-            )
-            
-            order_result = cur.fetchone()
-            order_id = order_result['id']
-            
-            for item in items:
-                cur.execute(
-                    """
-                    INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity, subtotal)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    """,
-                    (order_id, item.get('id'), item.get('name'), item.get('price'), 
-                     item.get('quantity', 1), item.get('price', 0) * item.get('quantity', 1))
-                )
-            
-            conn.commit()
+    body = json_body(event)
+    
+    customer_name = body.get('customer_name', '')
+    customer_phone = body.get('customer_phone', '')
+    customer_email = body.get('customer_email', '')
+    delivery_method = body.get('delivery_method', 'pickup')
+    delivery_address = body.get('delivery_address', '')
+    comments = body.get('comments', '')
+    items = body.get('items', [])
+    total_amount = body.get('total_amount', 0)
+    
+    if not customer_name or not customer_phone or not items:
+        return error_response(400, 'Не заполнены обязательные поля')
+    
+    if any(not isinstance(item.get('quantity', 1), int) or item.get('quantity', 1) < 1 for item in items):
+        return error_response(400, 'Некорректное количество товара')
+    
+    db_url = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    cur.execute(
+        """
+        INSERT INTO orders (customer_name, customer_phone, customer_email, 
+                            delivery_method, delivery_address, comments, total_amount, status)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        (customer_name, customer_phone, customer_email, 
+         delivery_method, delivery_address, comments, total_amount, 'new')
+    )
+    
+    order_result = cur.fetchone()
+    order_id = order_result['id']
+    
+    stock_dates = {}
+    for item in sorted(items, key=lambda i: i.get('id') or 0):
+        if not item.get('id'):
+            continue
+        
+        stock_date = reserve_stock(cur, item.get('id'), item.get('quantity', 1))
+        if stock_date is False:
+            conn.rollback()
             cur.close()
             conn.close()
-            
-            send_order_notification(order_id, customer_name, customer_email, customer_phone, 
-                                    delivery_method, delivery_address, items, total_amount, comments)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'message': 'Заказ успешно создан',
-                    'order_id': order_id
-                }),
-                'isBase64Encoded': False
-            }
-            
-        except Exception as e:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
-                'isBase64Encoded': False
-            }
-    
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Метод не поддерживается'}),
-        'isBase64Encoded': False
-    }
+            return json_response({
+                'error': f"Недостаточно товара «{item.get('name')}» на сегодня",
+                'product_id': item.get('id')
+            }, 409)
+        stock_dates[item.get('id')] = stock_date
+    
+    for item in items:
+        cur.execute(
+            """
+            INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity, subtotal, stock_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (order_id, item.get('id'), item.get('name'), item.get('price'), 
+             item.get('quantity', 1), item.get('price', 0) * item.get('quantity', 1),
+             stock_dates.get(item.get('id')))
+        )
+    
+    add_order_event(cur, order_id, 'order_created', {
+        'status': 'new',
+        'delivery_method': delivery_method,
+        'total_amount': total_amount,
+        'items': [{'product_id': item.get('id'), 'name': item.get('name'), 'quantity': item.get('quantity', 1)}
+                  for item in items]
+    })
+    
+    conn.commit()
+    cur.close()
+    conn.close()
+    
+    send_order_notification(order_id, customer_name, customer_email, customer_phone, 
+                            delivery_method, delivery_address, items, total_amount, comments)
+    
+    return json_response({
+        'message': 'Заказ успешно создан',
+        'order_id': order_id
+    })
+
+
+def reserve_stock(cur, product_id: int, quantity: int):
+    """Атомарное резервирование остатка на сегодня.
+    
+    Возвращает дату резерва, None для товара без ограничений или False, если остатка не хватает.
+    """
+    
+    cur.execute(
+        """
+        UPDATE product_stock
+        SET remaining = remaining - %s, updated_at = CURRENT_TIMESTAMP
+        WHERE product_id = %s AND stock_date = CURRENT_DATE AND remaining >= %s
+        RETURNING stock_date
+        """,
+        (quantity, product_id, quantity)
+    )
+    reserved = cur.fetchone()
+    if reserved:
+        return reserved['stock_date']
+    
+    cur.execute(
+        "SELECT 1 FROM product_stock WHERE product_id = %s AND stock_date = CURRENT_DATE",
+        (product_id,)
+    )
+    if cur.fetchone():
+        return False
+    
+    return None
 
 
 def send_order_notification(order_id: int, customer_name: str, customer_email: str, 
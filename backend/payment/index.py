@@ -1,229 +1,481 @@
 import json
 import os
+import time
 import base64
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from http_api import api_handler, error_response, json_body, json_response
+from order_events import add_order_event, add_order_events
+from perf_sampling import profiled
 
+YUKASSA_API_URL = os.environ.get('YUKASSA_API_URL', 'https://api.yookassa.ru/v3')
+
+# Статусы ЮKassa, после которых платёж больше не меняется
+TERMINAL_PAYMENT_STATUSES = ('succeeded', 'canceled')
+
+# payment_status заказа -> статус платежа ЮKassa
+TERMINAL_ORDER_STATUSES = {'paid': 'succeeded', 'canceled': 'canceled'}
+
+# статус платежа ЮKassa -> payment_status заказа
+ORDER_PAYMENT_STATUSES = {'succeeded': 'paid', 'canceled': 'canceled'}
+
+PENDING_STATUS_TTL = float(os.environ.get('PAYMENT_STATUS_TTL', '5'))
+
+# Верхняя граница частоты запросов сверки к ЮKassa (запросов в секунду)
+RECONCILE_MAX_RATE = float(os.environ.get('RECONCILE_MAX_RATE', '10'))
+
+# Тип события таймер-триггера Yandex Cloud Functions, которым сверка запускается по расписанию
+TIMER_EVENT_TYPE = 'yandex.cloud.events.serverless.triggers.TimerMessage'
+
+_status_cache = {}
+
+@profiled('payment')
+@api_handler('payment', ('POST', 'GET'))
 def handler(event: dict, context) -> dict:
     """API для создания платежей через ЮKassa"""
     
-    method = event.get('httpMethod', 'GET')
+    if is_timer_event(event):
+        return reconcile_on_timer(event)
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    method = event.get('httpMethod', 'GET')
     
     if method == 'POST':
-        try:
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action', '')
-            
-            if action == 'create_payment':
-                order_id = body.get('order_id')
-                amount = body.get('amount')
-                description = body.get('description', f'Оплата заказа #{order_id}')
-                return_url = body.get('return_url', 'https://your-site.com')
-                
-                if not order_id or not amount:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Не указаны обязательные параметры'}),
-                        'isBase64Encoded': False
-                    }
-                
-                shop_id = os.environ.get('YUKASSA_SHOP_ID', '')
-                secret_key = os.environ.get('YUKASSA_SECRET_KEY', '')
-                
-                if not shop_id or not secret_key:
-                    return {
-                        'statusCode': 500,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'ЮKassa не настроена. Добавьте ключи в секреты проекта'}),
-                        'isBase64Encoded': False
-                    }
+        body = json_body(event)
+        action = body.get('action', '')
+        
+        if action == 'create_payment':
+            order_id = body.get('order_id')
+            amount = body.get('amount')
+            description = body.get('description', f'Оплата заказа #{order_id}')
+            return_url = body.get('return_url', 'https://your-site.com')
+            
+            if not order_id or not amount:
+                return error_response(400, 'Не указаны обязательные параметры')
+            
+            shop_id = os.environ.get('YUKASSA_SHOP_ID', '')
+            secret_key = os.environ.get('YUKASSA_SECRET_KEY', '')
+            
+            if not shop_id or not secret_key:
+                return error_response(500, 'ЮKassa не настроена. Добавьте ключи в секреты проекта')
+            
+            auth_string = f'{shop_id}:{secret_key}'
+            auth_base64 = base64.b64encode(auth_string.encode()).decode()
+            
+            payment_data = {
+                'amount': {
+                    'value': str(amount),
+                    'currency': 'RUB'
+                },
+                'confirmation': {
+                    'type': 'redirect',
+                    'return_url': return_url
+                },
+                'capture': True,
+                'description': description,
+                'metadata': {
+                    'order_id': order_id
+                }
+            }
+            
+            headers = {
+                'Authorization': f'Basic {auth_base64}',
+                'Content-Type': 'application/json',
+                'Idempotence-Key': f'order-{order_id}-{context.request_id}'
+            }
+            
+            response = requests.post(
+                f'{YUKASSA_API_URL}/payments',
+                json=payment_data,
+                headers=headers,
+                timeout=10
+            )
+            
+            if response.status_code in [200, 201]:
+                payment_response = response.json()
+                payment_id = payment_response.get('id')
+                payment_url = payment_response.get('confirmation', {}).get('confirmation_url')
                 
-                auth_string = f'{shop_id}:{secret_key}'
-                auth_base64 = base64.b64encode(auth_string.encode()).decode()
+                db_url = os.environ.get('DATABASE_URL')
+                conn = psycopg2.connect(db_url)
+                cur = conn.cursor()
                 
-                payment_data = {
-                    'amount': {
-                        'value': str(amount),
-                        'currency': 'RUB'
-                    },
-                    'confirmation': {
-                        'type': 'redirect',
-                        'return_url': return_url
-                    },
-                    'capture': True,
-                    'description': description,
-                    'metadata': {
-                        'order_id': order_id
-                    }
-                }
+                cur.execute(
+                    """
+                    UPDATE orders 
+                    SET payment_method = 'online', 
+                        payment_status = 'pending',
+                        payment_id = %s,
+                        payment_url = %s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                    """,
+                    (payment_id, payment_url, order_id)
+                )
                 
-                headers = {
-                    'Authorization': f'Basic {auth_base64}',
-                    'Content-Type': 'application/json',
-                    'Idempotence-Key': f'order-{order_id}-{context.request_id}'
-                }
+                conn.commit()
+                cur.close()
+                conn.close()
                 
-                response = requests.post(
-                    'https://api.yookassa.ru/v3/payments',
-                    json=payment_data,
-                    headers=headers,
-                    timeout=10
+                return json_response({
+                    'payment_id': payment_id,
+                    'payment_url': payment_url,
+                    'status': payment_response.get('status')
+                })
+            else:
+                return json_response(
+                    {'error': 'Ошибка создания платежа в ЮKassa', 'details': response.text},
+                    response.status_code
                 )
+        
+        elif action == 'reconcile_payments':
+            reconcile_token = os.environ.get('RECONCILE_TOKEN', '')
+            request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+            request_token = request_headers.get('x-reconcile-token', '')
+            
+            if not reconcile_token or not hmac.compare_digest(request_token.encode(), reconcile_token.encode()):
+                return error_response(403, 'Доступ запрещён')
+            
+            try:
+                params = reconcile_params(body)
+            except (TypeError, ValueError) as e:
+                return error_response(400, f'Некорректные параметры сверки: {str(e)}')
+            
+            result = reconcile_pending_payments(**params)
+            
+            return json_response(result)
+    
+    elif method == 'GET':
+        query_params = event.get('queryStringParameters') or {}
+        payment_id = query_params.get('payment_id', '')
+        
+        if not payment_id:
+            return error_response(400, 'Не указан payment_id')
+        
+        cached_status = get_cached_status(payment_id)
+        if cached_status:
+            return json_response(cached_status)
+        
+        db_url = os.environ.get('DATABASE_URL')
+        conn = psycopg2.connect(db_url)
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cur.execute(
+            """
+            SELECT payment_status, total_amount
+            FROM orders
+            WHERE payment_id = %s
+            """,
+            (payment_id,)
+        )
+        order = cur.fetchone()
+        cur.close()
+        conn.close()
+        
+        if order and order['payment_status'] in TERMINAL_ORDER_STATUSES:
+            payment_status = TERMINAL_ORDER_STATUSES[order['payment_status']]
+            return json_response({
+                'payment_id': payment_id,
+                'status': payment_status,
+                'paid': payment_status == 'succeeded',
+                'amount': {'value': f"{order['total_amount']:.2f}", 'currency': 'RUB'}
+            })
+        
+        shop_id = os.environ.get('YUKASSA_SHOP_ID', '')
+        secret_key = os.environ.get('YUKASSA_SECRET_KEY', '')
+        
+        auth_string = f'{shop_id}:{secret_key}'
+        auth_base64 = base64.b64encode(auth_string.encode()).decode()
+        
+        headers = {
+            'Authorization': f'Basic {auth_base64}',
+            'Content-Type': 'application/json'
+        }
+        
+        response = requests.get(
+            f'{YUKASSA_API_URL}/payments/{payment_id}',
+            headers=headers,
+            timeout=10
+        )
+        
+        if response.status_code == 200:
+            payment_info = response.json()
+            payment_status = payment_info.get('status')
+            order_id = payment_info.get('metadata', {}).get('order_id')
+            
+            if payment_status in TERMINAL_PAYMENT_STATUSES and order_id:
+                db_url = os.environ.get('DATABASE_URL')
+                conn = psycopg2.connect(db_url)
+                cur = conn.cursor()
                 
-                if response.status_code in [200, 201]:
-                    payment_response = response.json()
-                    payment_id = payment_response.get('id')
-                    payment_url = payment_response.get('confirmation', {}).get('confirmation_url')
-                    
-                    db_url = os.environ.get('DATABASE_URL')
-                    conn = psycopg2.connect(db_url)
-                    cur = conn.cursor()
-                    
+                if payment_status == 'succeeded':
+                    # Отменённый заказ не подтверждаем: его резерв уже вернули в остаток и могли продать.
+                    # Оплата записывается, и такой заказ (cancelled + paid) ждёт возврата денег
                     cur.execute(
                         """
                         UPDATE orders 
-                        SET payment_method = 'online', 
-                            payment_status = 'pending',
-                            payment_id = %s,
-                            payment_url = %s,
+                        SET payment_status = 'paid',
+                            status = CASE WHEN status = 'cancelled' THEN status ELSE 'confirmed' END,
                             updated_at = CURRENT_TIMESTAMP
-                        WHERE id = %s
+                        WHERE id = %s AND payment_status <> 'paid'
+                        RETURNING id
                         """,
-                        (payment_id, payment_url, order_id)
+                        (order_id,)
                     )
-                    
-                    conn.commit()
-                    cur.close()
-                    conn.close()
-                    
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({
-                            'payment_id': payment_id,
-                            'payment_url': payment_url,
-                            'status': payment_response.get('status')
-                        }),
-                        'isBase64Encoded': False
-                    }
                 else:
-                    return {
-                        'statusCode': response.status_code,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Ошибка создания платежа в ЮKassa', 'details': response.text}),
-                        'isBase64Encoded': False
-                    }
-            
-        except Exception as e:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
-                'isBase64Encoded': False
+                    cur.execute(
+                        """
+                        UPDATE orders 
+                        SET payment_status = 'canceled',
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE id = %s AND payment_status NOT IN ('paid', 'canceled')
+                        RETURNING id
+                        """,
+                        (order_id,)
+                    )
+                
+                if cur.fetchone():
+                    add_order_event(cur, order_id, f'payment_{payment_status}', {'payment_id': payment_id})
+                
+                conn.commit()
+                cur.close()
+                conn.close()
+            
+            result = {
+                'payment_id': payment_id,
+                'status': payment_status,
+                'paid': payment_info.get('paid'),
+                'amount': payment_info.get('amount')
             }
+            
+            if payment_status not in TERMINAL_PAYMENT_STATUSES:
+                cache_status(payment_id, result)
+            
+            return json_response(result)
+        else:
+            return error_response(response.status_code, 'Ошибка получения статуса платежа')
     
-    elif method == 'GET':
-        try:
-            query_params = event.get('queryStringParameters') or {}
-            payment_id = query_params.get('payment_id', '')
-            
-            if not payment_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Не указан payment_id'}),
-                    'isBase64Encoded': False
-                }
+    return error_response(400, 'Неизвестное действие')
+
+
+def get_cached_status(payment_id: str):
+    """Статус незавершённого платежа из кэша процесса, если он ещё не устарел"""
+    
+    cached = _status_cache.get(payment_id)
+    if not cached:
+        return None
+    
+    expires_at, result = cached
+    if expires_at < time.monotonic():
+        _status_cache.pop(payment_id, None)
+        return None
+    
+    return result
+
+
+def cache_status(payment_id: str, result: dict):
+    """Кэширование статуса незавершённого платежа на PENDING_STATUS_TTL секунд"""
+    
+    if PENDING_STATUS_TTL <= 0:
+        return
+    
+    now = time.monotonic()
+    for key in [k for k, (expires_at, _) in _status_cache.items() if expires_at < now]:
+        del _status_cache[key]
+    
+    _status_cache[payment_id] = (now + PENDING_STATUS_TTL, result)
+
+
+def is_timer_event(event: dict) -> bool:
+    """Вызов таймер-триггером: события без httpMethod, которые платформа передаёт в messages"""
+    
+    messages = event.get('messages') or []
+    return not event.get('httpMethod') and bool(messages) and all(
+        (message.get('event_metadata') or {}).get('event_type') == TIMER_EVENT_TYPE for message in messages
+    )
+
+
+def reconcile_on_timer(event: dict) -> dict:
+    """Сверка по расписанию: параметры берутся из payload триггера (JSON, может быть пустым).
+    
+    Таймер вызывает функцию изнутри облака, через HTTP такое событие не передать,
+    поэтому X-Reconcile-Token здесь не нужен.
+    """
+    
+    payload = (event['messages'][0].get('details') or {}).get('payload') or '{}'
+    try:
+        params = reconcile_params(json.loads(payload))
+    except (TypeError, ValueError, AttributeError) as e:
+        print(f'Некорректный payload таймера сверки: {str(e)}')
+        return error_response(400, f'Некорректные параметры сверки: {str(e)}')
+    
+    result = reconcile_pending_payments(**params)
+    print(f'Сверка по таймеру: {json.dumps(result)}')
+    
+    return json_response(result)
+
+
+def reconcile_params(body: dict) -> dict:
+    """Параметры сверки из тела запроса, ограниченные безопасными диапазонами"""
+    
+    def clamp(value, low, high):
+        return max(low, min(high, value))
+    
+    rate_limit = float(body.get('rate_limit', RECONCILE_MAX_RATE))
+    if not rate_limit > 0:
+        raise ValueError('rate_limit должен быть больше нуля')
+    
+    return {
+        'older_than_minutes': clamp(int(body.get('older_than_minutes', 15)), 1, 7 * 24 * 60),
+        'after_id': max(int(body.get('after_id') or 0), 0),
+        'batch_size': clamp(int(body.get('batch_size', 50)), 1, 200),
+        'workers': clamp(int(body.get('workers', 4)), 1, 8),
+        'rate_limit': min(rate_limit, RECONCILE_MAX_RATE),
+        'max_seconds': clamp(float(body.get('max_seconds', 20)), 1, 25)
+    }
+
+
+def reconcile_pending_payments(older_than_minutes: int, after_id: int, batch_size: int,
+                               workers: int, rate_limit: float, max_seconds: float) -> dict:
+    """Сверка зависших pending-платежей со статусами в ЮKassa.
+    
+    Заказы обрабатываются пачками по возрастанию id, начиная после after_id. Если время
+    вышло раньше, чем закончились заказы, в ответе возвращается next_after_id для продолжения.
+    """
+    
+    deadline = time.monotonic() + max_seconds
+    
+    shop_id = os.environ.get('YUKASSA_SHOP_ID', '')
+    secret_key = os.environ.get('YUKASSA_SECRET_KEY', '')
+    auth_base64 = base64.b64encode(f'{shop_id}:{secret_key}'.encode()).decode()
+    
+    session = requests.Session()
+    session.headers.update({
+        'Authorization': f'Basic {auth_base64}',
+        'Content-Type': 'application/json'
+    })
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    
+    limiter = {'lock': threading.Lock(), 'interval': 1 / rate_limit, 'next_at': 0.0}
+    
+    db_url = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    checked = 0
+    updated = 0
+    failed = 0
+    done = False
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Пачка не больше, чем успеет уйти запросов при rate_limit до конца max_seconds
+            limit = min(batch_size, int(rate_limit * (deadline - time.monotonic())))
+            if limit < 1:
+                break
             
-            shop_id = os.environ.get('YUKASSA_SHOP_ID', '')
-            secret_key = os.environ.get('YUKASSA_SECRET_KEY', '')
+            cur.execute(
+                """
+                SELECT id, payment_id
+                FROM orders
+                WHERE payment_status = 'pending'
+                  AND payment_id IS NOT NULL
+                  AND updated_at < CURRENT_TIMESTAMP - make_interval(mins => %s)
+                  AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (older_than_minutes, after_id, limit)
+            )
+            batch = cur.fetchall()
             
-            auth_string = f'{shop_id}:{secret_key}'
-            auth_base64 = base64.b64encode(auth_string.encode()).decode()
+            if not batch:
+                done = True
+                break
             
-            headers = {
-                'Authorization': f'Basic {auth_base64}',
-                'Content-Type': 'application/json'
-            }
+            statuses = list(pool.map(
+                lambda order: fetch_payment_status(session, limiter, order['payment_id'], deadline),
+                batch
+            ))
             
-            response = requests.get(
-                f'https://api.yookassa.ru/v3/payments/{payment_id}',
-                headers=headers,
-                timeout=10
-            )
+            updates = [
+                (order['id'], ORDER_PAYMENT_STATUSES[status])
+                for order, status in zip(batch, statuses)
+                if status in ORDER_PAYMENT_STATUSES
+            ]
             
-            if response.status_code == 200:
-                payment_info = response.json()
-                payment_status = payment_info.get('status')
-                
-                if payment_status == 'succeeded':
-                    order_id = payment_info.get('metadata', {}).get('order_id')
-                    
-                    if order_id:
-                        db_url = os.environ.get('DATABASE_URL')
-                        conn = psycopg2.connect(db_url)
-                        cur = conn.cursor()
-                        
-                        cur.execute(
-                            """
-                            UPDATE orders 
-                            SET payment_status = 'paid',
-                                status = 'confirmed',
-                                updated_at = CURRENT_TIMESTAMP
-                            WHERE id = %s
-                            """,
-                            (order_id,)
-                        )
-                        
-                        conn.commit()
-                        cur.close()
-                        conn.close()
+            if updates:
+                changed = execute_values(
+                    cur,
+                    """
+                    UPDATE orders o
+                    SET payment_status = v.payment_status,
+                        status = CASE WHEN v.payment_status = 'paid' AND o.status <> 'cancelled'
+                                      THEN 'confirmed' ELSE o.status END,
+                        updated_at = CURRENT_TIMESTAMP
+                    FROM (VALUES %s) AS v(id, payment_status)
+                    WHERE o.id = v.id AND o.payment_status = 'pending'
+                    RETURNING o.id, o.payment_id, o.payment_status
+                    """,
+                    updates,
+                    page_size=len(updates),
+                    fetch=True
+                )
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'payment_id': payment_id,
-                        'status': payment_status,
-                        'paid': payment_info.get('paid'),
-                        'amount': payment_info.get('amount')
-                    }),
-                    'isBase64Encoded': False
-                }
-            else:
-                return {
-                    'statusCode': response.status_code,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Ошибка получения статуса платежа'}),
-                    'isBase64Encoded': False
-                }
+                add_order_events(cur, [
+                    (row['id'], f"payment_{TERMINAL_ORDER_STATUSES[row['payment_status']]}",
+                     {'payment_id': row['payment_id']})
+                    for row in changed
+                ])
                 
-        except Exception as e:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'}),
-                'isBase64Encoded': False
-            }
+                updated += len(changed)
+            
+            conn.commit()
+            
+            checked += len(batch)
+            failed += statuses.count(None)
+            after_id = batch[-1]['id']
+    
+    cur.close()
+    conn.close()
+    session.close()
     
     return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Метод не поддерживается'}),
-        'isBase64Encoded': False
+        'checked': checked,
+        'updated': updated,
+        'failed': failed,
+        'done': done,
+        'next_after_id': None if done else after_id
     }
+
+
+def fetch_payment_status(session, limiter: dict, payment_id: str, deadline: float):
+    """Запрос статуса платежа в ЮKassa с ограничением частоты; None при ошибке"""
+    
+    with limiter['lock']:
+        now = time.monotonic()
+        wait = limiter['next_at'] - now
+        limiter['next_at'] = max(now, limiter['next_at']) + limiter['interval']
+    
+    if wait > 0:
+        time.sleep(wait)
+    
+    try:
+        # Таймаут не выводит запуск за max_seconds, но и не короче секунды
+        timeout = max(min(10, deadline - time.monotonic()), 1)
+        response = session.get(f'{YUKASSA_API_URL}/payments/{payment_id}', timeout=timeout)
+    except requests.RequestException as e:
+        print(f'Ошибка запроса статуса платежа {payment_id}: {str(e)}')
+        return None
+    
+    if response.status_code != 200:
+        print(f'ЮKassa вернула {response.status_code} для платежа {payment_id}')
+        return None
+    
+    return response.json().get('status')
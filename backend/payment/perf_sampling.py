@@ -0,0 +1,131 @@
+"""Сэмплирование запросов облачных функций в perf_samples (сводка — admin action=perf).
+
+Исходник лежит в backend/_shared, копии в каталогах функций обновляет scripts/sync_shared.py.
+
+Каждый PERF_TIMING_EVERY-й запрос записывается только со временем ответа: по таким
+записям считаются перцентили. Каждый PERF_SAMPLE_EVERY-й идёт под cProfile и
+записывается с топом функций и временем SQL. Запросы дольше PERF_SLOW_MS записываются
+всегда, без профиля. 0 выключает соответствующий режим.
+
+Цена: когда все PERF_* выключены, handler не оборачивается вовсе. Включённая обёртка
+на запросе, который не записывается, стоит счётчик и два perf_counter. Записанный
+сэмпл синхронно добавляет к ответу подключение к базе и INSERT, а раз в
+PERF_RETENTION_EVERY записей ещё и DELETE старых сэмплов. Поэтому PERF_* стоит
+выбирать так, чтобы записывалась малая доля запросов. На локальной базе
+(scripts/bench_perf_sampling.py) обёртка без записи стоит около 2 мкс на запрос, запись
+сэмпла — около 5 мс, чистка на каждой записи — ещё 1-2 мс.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import time
+
+import psycopg2
+
+PERF_TIMING_EVERY = int(os.environ.get('PERF_TIMING_EVERY', '0'))
+PERF_SAMPLE_EVERY = int(os.environ.get('PERF_SAMPLE_EVERY', '0'))
+PERF_SLOW_MS = float(os.environ.get('PERF_SLOW_MS', '0'))
+PERF_RETENTION_DAYS = int(os.environ.get('PERF_RETENTION_DAYS', '7'))
+PERF_RETENTION_EVERY = int(os.environ.get('PERF_RETENTION_EVERY', '100'))
+
+_perf_requests = 0
+_perf_inserts = 0
+
+
+def profiled(handler_name: str):
+    """Сэмплирование handler в perf_samples; при выключенных PERF_* handler возвращается без обёртки"""
+    
+    def decorator(handler):
+        if not (PERF_TIMING_EVERY or PERF_SAMPLE_EVERY or PERF_SLOW_MS):
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapped(event: dict, context) -> dict:
+            global _perf_requests
+            _perf_requests += 1
+            request_number = _perf_requests
+            
+            profiler = None
+            if PERF_SAMPLE_EVERY and request_number % PERF_SAMPLE_EVERY == 0:
+                try:
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                except ValueError:
+                    # Python 3.12+ не включает второй профайлер, пока работает первый
+                    profiler = None
+            
+            started_at = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                if profiler:
+                    profiler.disable()
+            duration_ms = (time.perf_counter() - started_at) * 1000
+            
+            sampled = any(every and request_number % every == 0 for every in (PERF_TIMING_EVERY, PERF_SAMPLE_EVERY))
+            is_slow = bool(PERF_SLOW_MS) and duration_ms >= PERF_SLOW_MS
+            if sampled or is_slow:
+                try:
+                    save_perf_sample(handler_name, event, response, duration_ms, profiler, sampled, is_slow)
+                except Exception as e:
+                    print(f'Ошибка записи perf_samples: {str(e)}')
+            
+            return response
+        
+        return wrapped
+    
+    return decorator
+
+
+def save_perf_sample(handler_name: str, event: dict, response: dict, duration_ms: float, profiler,
+                     sampled: bool, is_slow: bool):
+    """Запись запроса в perf_samples: время и размеры тела, для профиля — SQL и топ функций"""
+    
+    global _perf_inserts
+    _perf_inserts += 1
+    
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    if not action and event.get('body'):
+        try:
+            action = json.loads(event['body']).get('action', '')
+        except (ValueError, AttributeError):
+            pass
+    
+    sql_calls = sql_ms = top_functions = None
+    if profiler:
+        stats = pstats.Stats(profiler).stats
+        sql = [(calls, cumtime) for (_, _, name), (_, calls, _, cumtime, _) in stats.items()
+               if name.startswith("<method 'execute' of 'psycopg2.")]
+        sql_calls = sum(calls for calls, _ in sql)
+        sql_ms = sum(cumtime for _, cumtime in sql) * 1000
+        top_functions = json.dumps([
+            {'function': f'{os.path.basename(filename)}:{line}({name})', 'calls': calls,
+             'tottime_ms': round(tottime * 1000, 2), 'cumtime_ms': round(cumtime * 1000, 2)}
+            for (filename, line, name), (_, calls, tottime, cumtime, _)
+            in sorted(stats.items(), key=lambda s: s[1][2], reverse=True)[:10]
+        ])
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO perf_samples (handler, action, method, status_code, duration_ms, profiled, sampled, is_slow,
+                                  request_bytes, response_bytes, sql_calls, sql_ms, top_functions)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        (handler_name, action[:50], event.get('httpMethod'), response.get('statusCode'), duration_ms,
+         profiler is not None, sampled, is_slow, len(event.get('body') or ''), len(response.get('body') or ''),
+         sql_calls, sql_ms, top_functions)
+    )
+    # Первая запись экземпляра функции и дальше каждая PERF_RETENTION_EVERY-я чистят старые сэмплы
+    if (_perf_inserts - 1) % max(PERF_RETENTION_EVERY, 1) == 0:
+        cur.execute(
+            "DELETE FROM perf_samples WHERE handler = %s AND created_at < CURRENT_TIMESTAMP - make_interval(days => %s)",
+            (handler_name, PERF_RETENTION_DAYS)
+        )
+    conn.commit()
+    cur.close()
+    conn.close()
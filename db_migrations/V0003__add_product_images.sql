@@ -0,0 +1,14 @@
+-- Нарезанные варианты изображений товаров
+
+CREATE TABLE IF NOT EXISTS product_images (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER REFERENCES products(id),
+    source_url TEXT,
+    content_hash VARCHAR(64) NOT NULL,
+    format VARCHAR(10) NOT NULL,
+    width INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_images_product ON product_images(product_id);
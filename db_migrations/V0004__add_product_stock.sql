@@ -0,0 +1,13 @@
+-- Остатки и дневная производственная мощность товаров
+
+CREATE TABLE IF NOT EXISTS product_stock (
+    product_id INTEGER REFERENCES products(id),
+    stock_date DATE NOT NULL DEFAULT CURRENT_DATE,
+    capacity INTEGER NOT NULL CHECK (capacity >= 0),
+    remaining INTEGER NOT NULL CHECK (remaining >= 0),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (product_id, stock_date)
+);
+
+-- День, на который зарезервирована позиция (NULL — товар без ограничений)
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS stock_date DATE;
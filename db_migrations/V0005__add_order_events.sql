@@ -0,0 +1,30 @@
+-- Журнал событий заказов для кухни, курьеров и других потребителей.
+-- order_events только дополняется, состояние обработки хранится по группам потребителей
+-- в order_event_deliveries: каждая группа получает каждое событие
+
+CREATE TABLE IF NOT EXISTS order_events (
+    id BIGSERIAL PRIMARY KEY,
+    order_id INTEGER REFERENCES orders(id),
+    event_type VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events(order_id);
+
+CREATE TABLE IF NOT EXISTS order_event_consumer_groups (
+    consumer_group VARCHAR(100) PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS order_event_deliveries (
+    consumer_group VARCHAR(100) NOT NULL REFERENCES order_event_consumer_groups(consumer_group),
+    event_id BIGINT NOT NULL REFERENCES order_events(id),
+    claimed_by VARCHAR(100),
+    claimed_at TIMESTAMP,
+    processed_at TIMESTAMP,
+    PRIMARY KEY (consumer_group, event_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_order_event_deliveries_pending
+    ON order_event_deliveries(consumer_group, event_id) WHERE processed_at IS NULL;
@@ -0,0 +1,22 @@
+-- Сэмплы профилирования медленных и выборочных запросов
+
+CREATE TABLE IF NOT EXISTS perf_samples (
+    id BIGSERIAL PRIMARY KEY,
+    handler VARCHAR(50) NOT NULL,
+    action VARCHAR(50),
+    method VARCHAR(10),
+    status_code INTEGER,
+    duration_ms REAL NOT NULL,
+    profiled BOOLEAN NOT NULL DEFAULT false,
+    sampled BOOLEAN NOT NULL DEFAULT false,
+    is_slow BOOLEAN NOT NULL DEFAULT false,
+    request_bytes INTEGER,
+    response_bytes INTEGER,
+    sql_calls INTEGER,
+    sql_ms REAL,
+    top_functions JSONB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_perf_samples_handler ON perf_samples(handler, created_at);
+CREATE INDEX IF NOT EXISTS idx_perf_samples_created ON perf_samples(created_at);
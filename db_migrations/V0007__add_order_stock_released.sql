@@ -0,0 +1,3 @@
+-- Момент возврата резерва отменённого заказа в остаток (NULL — резерв действует)
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS stock_released_at TIMESTAMP;
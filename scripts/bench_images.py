@@ -0,0 +1,67 @@
+"""Бенчмарк нарезки изображений товаров (resize_image из backend/admin).
+
+Генерирует фотоподобные исходники и прогоняет нарезку всех ширин последовательно
+и в пуле процессов разного размера. База и S3 не нужны.
+
+Запуск:
+    python scripts/bench_images.py --images 24 --size 2400x1600 --workers 1,2,4
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from devserver import load_function  # noqa: E402
+
+admin = load_function('admin')
+
+
+def make_source(width: int, height: int, seed: int) -> bytes:
+    """JPEG-исходник с шумом и размытием, чтобы кодирование было похоже на фото"""
+
+    noise = Image.effect_noise((width, height), 60 + seed % 40).filter(ImageFilter.GaussianBlur(2))
+    image = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пропускная способность нарезки изображений')
+    parser.add_argument('--images', type=int, default=24)
+    parser.add_argument('--size', default='2400x1600')
+    parser.add_argument('--workers', default='1,2,4')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    sources = [make_source(width, height, seed) for seed in range(args.images)]
+    jobs = [(source, target) for source in sources for target in admin.IMAGE_WIDTHS]
+    variants_per_job = len(admin.IMAGE_FORMATS)
+
+    print(f'{args.images} исходников {width}x{height}, ширины {admin.IMAGE_WIDTHS}, '
+          f'форматы {tuple(admin.IMAGE_FORMATS)}, CPU: {os.cpu_count()}')
+
+    started_at = time.perf_counter()
+    for job in jobs:
+        admin.resize_image(job)
+    elapsed = time.perf_counter() - started_at
+    print(f'без пула   : {args.images / elapsed:6.2f} изобр/с, {len(jobs) * variants_per_job / elapsed:7.2f} вариантов/с')
+
+    for workers in (int(w) for w in args.workers.split(',')):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(admin.resize_image, jobs[:workers]))
+            started_at = time.perf_counter()
+            list(pool.map(admin.resize_image, jobs))
+            elapsed = time.perf_counter() - started_at
+        print(f'пул x{workers:<3}   : {args.images / elapsed:6.2f} изобр/с, {len(jobs) * variants_per_job / elapsed:7.2f} вариантов/с')
+
+
+if __name__ == '__main__':
+    main()
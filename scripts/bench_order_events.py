@@ -0,0 +1,168 @@
+"""Бенчмарк потребителей событий заказов (admin action=claim_events / ack_events).
+
+Сначала проверяет доставку по группам: события, записанные через add_order_event,
+получают и "кухня", и "курьеры", каждая группа ровно по одному разу, даже когда в
+группе несколько параллельных воркеров. Затем меряет события в секунду для разного
+числа воркеров одной группы на одной и той же пачке событий.
+
+Запуск (база с применёнными db_migrations):
+    DATABASE_URL=postgresql://... python scripts/bench_order_events.py --events 5000 --workers 1,2,4,8
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from devserver import load_function  # noqa: E402
+
+admin = load_function('admin')
+
+
+def call_admin(action: str, body: dict) -> dict:
+    response = admin.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {'action': action},
+        'body': json.dumps(body)
+    }, None)
+    assert response['statusCode'] == 200, response
+    return json.loads(response['body'])
+
+
+def consume(consumer_group: str, workers: int, batch: int) -> tuple:
+    """Воркеры группы разбирают очередь до конца: список id по воркерам и время в секундах"""
+
+    received = [[] for _ in range(workers)]
+
+    def worker(index: int):
+        consumer = f'worker-{index}'
+        while True:
+            events = call_admin('claim_events', {'consumer_group': consumer_group, 'consumer': consumer,
+                                                 'limit': batch})['events']
+            if not events:
+                return
+            event_ids = [event['id'] for event in events]
+            received[index].extend(event_ids)
+            call_admin('ack_events', {'consumer_group': consumer_group, 'consumer': consumer,
+                                      'event_ids': event_ids})
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return received, time.perf_counter() - started_at
+
+
+def exactly_once(received: list, expected: set) -> bool:
+    all_ids = [event_id for ids in received for event_id in ids]
+    return len(all_ids) == len(expected) and set(all_ids) == expected
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='События в секунду в зависимости от числа воркеров')
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    run = uuid.uuid4().hex[:8]
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    cur.execute(
+        """
+        INSERT INTO orders (customer_name, customer_phone, delivery_method, total_amount)
+        VALUES ('Бенчмарк событий', '+70000000000', 'pickup', 100)
+        RETURNING id
+        """
+    )
+    order_id = cur.fetchone()['id']
+    groups = []
+    checks = []
+
+    def register(consumer_group: str):
+        cur.execute("INSERT INTO order_event_consumer_groups (consumer_group) VALUES (%s)", (consumer_group,))
+        groups.append(consumer_group)
+
+    try:
+        # Доставка по группам через настоящую запись событий
+        kitchen, couriers = f'bench-{run}-kitchen', f'bench-{run}-couriers'
+        register(kitchen)
+        register(couriers)
+        cur.execute("SELECT COALESCE(MAX(id), 0) as id FROM order_events")
+        first_id = cur.fetchone()['id']
+        for i in range(200):
+            admin.add_order_event(cur, order_id, 'status_changed', {'status': 'confirmed', 'n': i})
+        cur.execute("SELECT id FROM order_events WHERE order_id = %s AND id > %s", (order_id, first_id))
+        fanout_ids = {row['id'] for row in cur.fetchall()}
+
+        results = {}
+        threads = [threading.Thread(target=lambda g=g: results.__setitem__(g, consume(g, 3, 25)[0]))
+                   for g in (kitchen, couriers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        checks += [
+            ('кухня получила все события ровно по разу', exactly_once(results[kitchen], fanout_ids)),
+            ('курьеры получили все события ровно по разу', exactly_once(results[couriers], fanout_ids))
+        ]
+
+        # Пропускная способность одной группы в зависимости от числа воркеров
+        cur.execute(
+            """
+            INSERT INTO order_events (order_id, event_type, payload)
+            SELECT %s, 'status_changed', jsonb_build_object('status', 'confirmed', 'n', n)
+            FROM generate_series(1, %s) n
+            RETURNING id
+            """,
+            (order_id, args.events)
+        )
+        bench_ids = {row['id'] for row in cur.fetchall()}
+
+        print(f"{args.events} событий, пачка {args.batch}, CPU: {os.cpu_count()}")
+        for workers in (int(w) for w in args.workers.split(',')):
+            consumer_group = f'bench-{run}-w{workers}'
+            register(consumer_group)
+            cur.execute(
+                """
+                INSERT INTO order_event_deliveries (consumer_group, event_id)
+                SELECT %s, id FROM order_events WHERE id = ANY(%s)
+                """,
+                (consumer_group, list(bench_ids))
+            )
+            received, elapsed = consume(consumer_group, workers, args.batch)
+            print(f'воркеров {workers:<3}: {args.events / elapsed:8.0f} событий/с '
+                  f'(по воркерам: {", ".join(str(len(ids)) for ids in received)})')
+            checks.append((f'{workers} воркеров: каждое событие ровно один раз', exactly_once(received, bench_ids)))
+    finally:
+        cur.execute("DELETE FROM order_event_deliveries WHERE consumer_group = ANY(%s)", (groups,))
+        cur.execute("DELETE FROM order_event_consumer_groups WHERE consumer_group = ANY(%s)", (groups,))
+        cur.execute(
+            "DELETE FROM order_event_deliveries WHERE event_id IN (SELECT id FROM order_events WHERE order_id = %s)",
+            (order_id,)
+        )
+        cur.execute("DELETE FROM order_events WHERE order_id = %s", (order_id,))
+        cur.execute("DELETE FROM orders WHERE id = %s", (order_id,))
+        conn.close()
+
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Бенчмарк цены сэмплирования perf_samples (backend/_shared/perf_sampling.py).
+
+Оборачивает пустой handler и handler orders-get с настоящим запросом к базе и меряет
+среднее время запроса в режимах: без обёртки, обёртка без записи, запись времени
+каждого запроса (с чисткой старых сэмплов раз в PERF_RETENTION_EVERY записей и на
+каждой записи) и cProfile на каждом запросе. Разница с режимом "выключено" и есть
+цена сэмплирования на записанный запрос.
+
+Запуск (база с применёнными db_migrations):
+    DATABASE_URL=postgresql://... python scripts/bench_perf_sampling.py --requests 500
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+import psycopg2
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path.insert(0, BACKEND_DIR)
+
+from devserver import load_function  # noqa: E402
+import perf_sampling  # noqa: E402
+
+orders_get = load_function('orders-get')
+
+# Режим -> PERF_TIMING_EVERY, PERF_SAMPLE_EVERY, PERF_RETENTION_EVERY
+MODES = {
+    'выключено': (0, 0, 100),
+    'обёртка без записи': (10 ** 9, 0, 100),
+    'время, чистка раз в 100': (1, 0, 100),
+    'время, чистка каждый раз': (1, 0, 1),
+    'cProfile на каждом': (0, 1, 100)
+}
+
+
+def empty_handler(event: dict, context) -> dict:
+    return {'statusCode': 200, 'headers': {}, 'body': '{}'}
+
+
+def measure(handler_name: str, handler, event: dict, mode: tuple, requests: int) -> float:
+    """Среднее время запроса в миллисекундах для режима сэмплирования"""
+
+    perf_sampling.PERF_TIMING_EVERY, perf_sampling.PERF_SAMPLE_EVERY, perf_sampling.PERF_RETENTION_EVERY = mode
+    perf_sampling._perf_requests = perf_sampling._perf_inserts = 0
+    wrapped = perf_sampling.profiled(handler_name)(handler)
+
+    started_at = time.perf_counter()
+    for _ in range(requests):
+        wrapped(event, None)
+    return (time.perf_counter() - started_at) * 1000 / requests
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Цена записи perf_samples на запрос')
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    run = uuid.uuid4().hex[:8]
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    perf_sampling.PERF_SLOW_MS = 0
+    checks = []
+
+    handlers = {
+        'пустой handler': (empty_handler, {'httpMethod': 'GET'}),
+        'orders-get': (orders_get.handler, {'httpMethod': 'GET', 'queryStringParameters': {'order_id': '0'}})
+    }
+
+    try:
+        print(f"{args.requests} запросов на режим, CPU: {os.cpu_count()}")
+        for label, (handler, event) in handlers.items():
+            handler_name = f'bench-{run}-{label[:10]}'
+            print(label)
+            baseline = None
+            for mode_name, mode in MODES.items():
+                cur.execute("SELECT COUNT(*) FROM perf_samples WHERE handler = %s", (handler_name,))
+                before = cur.fetchone()[0]
+                ms = measure(handler_name, handler, event, mode, args.requests)
+                cur.execute("SELECT COUNT(*) FROM perf_samples WHERE handler = %s", (handler_name,))
+                written = cur.fetchone()[0] - before
+
+                baseline = ms if baseline is None else baseline
+                print(f'  {mode_name:<26}: {ms:8.3f} мс/запрос ({ms - baseline:+.3f}), записано {written}')
+                expected = args.requests if mode[0] == 1 or mode[1] == 1 else 0
+                checks.append((f'{label}, {mode_name}: записано {expected}', written == expected))
+
+            cur.execute(
+                """
+                SELECT COUNT(*) FILTER (WHERE sampled AND NOT profiled), COUNT(*) FILTER (WHERE profiled)
+                FROM perf_samples WHERE handler = %s
+                """,
+                (handler_name,)
+            )
+            timing, profiled = cur.fetchone()
+            checks.append((f'{label}: профилированные запросы отделены от выборки времени',
+                           timing == 2 * args.requests and profiled == args.requests))
+    finally:
+        cur.execute("DELETE FROM perf_samples WHERE handler LIKE %s", (f'bench-{run}-%',))
+        conn.close()
+
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Проверка кэша статусов платежей (GET payment_id) на локальной заглушке ЮKassa.
+
+Браузер опрашивает статус платежа сначала пока он pending, потом после оплаты.
+Скрипт считает запросы к ЮKassa и записи в строку заказа и сравнивает их с числом опросов.
+
+Запуск (база с применёнными db_migrations):
+    DATABASE_URL=postgresql://... python scripts/check_payment_cache.py
+"""
+
+import os
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from fake_yookassa import FakeYooKassa  # noqa: E402
+
+POLLS = 50
+TTL = 1.0
+
+
+def main() -> int:
+    gateway = FakeYooKassa().start()
+    os.environ['YUKASSA_API_URL'] = gateway.url
+    os.environ['PAYMENT_STATUS_TTL'] = str(TTL)
+
+    from devserver import load_function
+    payment = load_function('payment')
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    payment_id = f'check-{uuid.uuid4()}'
+    cur.execute(
+        """
+        INSERT INTO orders (customer_name, customer_phone, delivery_method, total_amount,
+                            payment_method, payment_status, payment_id)
+        VALUES ('Проверка кэша', '+70000000000', 'pickup', 360, 'online', 'pending', %s)
+        RETURNING id
+        """,
+        (payment_id,)
+    )
+    order_id = cur.fetchone()[0]
+    gateway.add_payment(payment_id, order_id, '360.00')
+
+    context = SimpleNamespace(request_id='check')
+
+    def row_version() -> str:
+        cur.execute("SELECT xmin::text FROM orders WHERE id = %s", (order_id,))
+        return cur.fetchone()[0]
+
+    def poll_series(expected_status: str):
+        """POLLS опросов подряд: число запросов к ЮKassa и число новых версий строки заказа"""
+        calls_before = gateway.calls
+        version = row_version()
+        writes = 0
+        for _ in range(POLLS):
+            response = payment.handler(
+                {'httpMethod': 'GET', 'queryStringParameters': {'payment_id': payment_id}}, context
+            )
+            assert response['statusCode'] == 200, response
+            assert f'"status": "{expected_status}"' in response['body'], response['body']
+            current = row_version()
+            if current != version:
+                version = current
+                writes += 1
+        return gateway.calls - calls_before, writes
+
+    try:
+        pending_calls, pending_writes = poll_series('pending')
+
+        gateway.set_status(payment_id, 'succeeded')
+        time.sleep(TTL + 0.1)
+
+        paid_calls, paid_writes = poll_series('succeeded')
+
+        cur.execute(
+            "SELECT COUNT(*) FROM order_events WHERE order_id = %s AND event_type = 'payment_succeeded'",
+            (order_id,)
+        )
+        events = cur.fetchone()[0]
+    finally:
+        cur.execute(
+            "DELETE FROM order_event_deliveries WHERE event_id IN (SELECT id FROM order_events WHERE order_id = %s)",
+            (order_id,)
+        )
+        cur.execute("DELETE FROM order_events WHERE order_id = %s", (order_id,))
+        cur.execute("DELETE FROM orders WHERE id = %s", (order_id,))
+        conn.close()
+        gateway.stop()
+
+    print(f'pending:   {POLLS} опросов -> {pending_calls} запросов к ЮKassa, {pending_writes} записей в orders')
+    print(f'succeeded: {POLLS} опросов -> {paid_calls} запросов к ЮKassa, {paid_writes} записей в orders')
+    print(f'без кэша было бы {2 * POLLS} запросов к ЮKassa и {POLLS} записей в orders')
+
+    checks = [
+        ('pending-статус берётся из кэша процесса', pending_calls == 1),
+        ('pending-опросы ничего не пишут', pending_writes == 0),
+        ('оплаченный платёж запрашивается у ЮKassa один раз', paid_calls == 1),
+        ('заказ помечается оплаченным одной записью', paid_writes == 1),
+        ('событие payment_succeeded записано один раз', events == 1)
+    ]
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
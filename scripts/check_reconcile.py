@@ -0,0 +1,173 @@
+"""Проверка сверки зависших платежей (payment action=reconcile_payments) на заглушке ЮKassa.
+
+Создаёт давние pending-заказы со смесью статусов в заглушке (succeeded, canceled,
+pending, неизвестный платёж; один оплаченный заказ уже отменён), гоняет сверку
+короткими запусками с продолжением по next_after_id и сверяет результат, число
+запросов к ЮKassa и ограничение частоты. Затем проверяет, что запуск укладывается
+в max_seconds, и запуск таймер-триггером.
+
+Запуск (база с применёнными db_migrations):
+    DATABASE_URL=postgresql://... python scripts/check_reconcile.py
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from fake_yookassa import FakeYooKassa  # noqa: E402
+
+ORDERS = 40
+RATE_LIMIT = 40
+TOKEN = 'check-token'
+STATUSES = ('succeeded', 'canceled', 'pending', 'missing')
+
+
+def main() -> int:
+    gateway = FakeYooKassa(latency=0.02).start()
+    os.environ['YUKASSA_API_URL'] = gateway.url
+    os.environ['RECONCILE_MAX_RATE'] = str(RATE_LIMIT)
+
+    from devserver import load_function
+    payment = load_function('payment')
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    # Заказы других проверок не должны попасть в сверку: берём только созданные здесь
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM orders")
+    start_after_id = cur.fetchone()[0]
+
+    expected = {}
+    cancelled_order_id = None
+    for i in range(ORDERS):
+        status = STATUSES[i % len(STATUSES)]
+        payment_id = f'reconcile-{uuid.uuid4()}'
+        cur.execute(
+            """
+            INSERT INTO orders (customer_name, customer_phone, delivery_method, total_amount,
+                                payment_method, payment_status, payment_id, updated_at)
+            VALUES ('Проверка сверки', '+70000000000', 'pickup', 500, 'online', 'pending', %s,
+                    CURRENT_TIMESTAMP - interval '1 hour')
+            RETURNING id
+            """,
+            (payment_id,)
+        )
+        order_id = cur.fetchone()[0]
+        if i == 0:
+            cur.execute("UPDATE orders SET status = 'cancelled' WHERE id = %s", (order_id,))
+            cancelled_order_id = order_id
+        if status != 'missing':
+            gateway.add_payment(payment_id, order_id, '500.00', status)
+        expected[order_id] = {'succeeded': 'paid', 'canceled': 'canceled'}.get(status, 'pending')
+
+    def reconcile(body: dict, token: str = TOKEN) -> dict:
+        # сверка печатает строку на каждый неизвестный ЮKassa платёж
+        with contextlib.redirect_stdout(io.StringIO()):
+            return payment.handler({
+                'httpMethod': 'POST',
+                'headers': {'X-Reconcile-Token': token} if token else {},
+                'body': json.dumps(dict(body, action='reconcile_payments'))
+            }, SimpleNamespace(request_id='check'))
+
+    checks = []
+    try:
+        os.environ.pop('RECONCILE_TOKEN', None)
+        checks.append(('без RECONCILE_TOKEN сверка запрещена', reconcile({})['statusCode'] == 403))
+        os.environ['RECONCILE_TOKEN'] = TOKEN
+        checks.append(('неверный токен отклоняется', reconcile({}, token='wrong')['statusCode'] == 403))
+        checks.append(('нечисловые параметры -> 400', reconcile({'workers': 'many'})['statusCode'] == 400))
+        checks.append(('rate_limit=0 -> 400', reconcile({'rate_limit': 0})['statusCode'] == 400))
+
+        runs = 0
+        after_id = start_after_id
+        checked = updated = 0
+        started_at = time.perf_counter()
+        while True:
+            response = reconcile({'after_id': after_id, 'batch_size': 7, 'workers': 1000,
+                                  'rate_limit': 10_000, 'max_seconds': 0})
+            assert response['statusCode'] == 200, response
+            result = json.loads(response['body'])
+            runs += 1
+            checked += result['checked']
+            updated += result['updated']
+            if result['done']:
+                break
+            after_id = result['next_after_id']
+        elapsed = time.perf_counter() - started_at
+
+        cur.execute("SELECT id, payment_status FROM orders WHERE id = ANY(%s)", (list(expected),))
+        actual = dict(cur.fetchall())
+        cur.execute("SELECT status FROM orders WHERE id = %s", (cancelled_order_id,))
+        cancelled_status = cur.fetchone()[0]
+        cur.execute(
+            "SELECT COUNT(*) FROM order_events WHERE order_id = ANY(%s) AND event_type LIKE 'payment_%%'",
+            (list(expected),)
+        )
+        events = cur.fetchone()[0]
+        terminal = sum(1 for status in expected.values() if status != 'pending')
+
+        print(f'{ORDERS} заказов: {runs} запусков, проверено {checked}, обновлено {updated}, '
+              f'{gateway.calls} запросов к ЮKassa за {elapsed:.2f} с (лимит {RATE_LIMIT}/с)')
+
+        checks += [
+            ('сверка продолжается по next_after_id до конца', runs > 1 and checked == ORDERS),
+            ('каждый платёж запрошен у ЮKassa один раз', gateway.calls == ORDERS),
+            ('статусы заказов совпадают с ЮKassa', actual == expected),
+            ('оплата отменённого заказа не подтверждает его', cancelled_status == 'cancelled'),
+            ('обновлены только завершённые платежи', updated == terminal),
+            ('по событию на каждый завершённый платёж', events == terminal),
+            ('частота не выше RECONCILE_MAX_RATE, несмотря на rate_limit=10000',
+             elapsed >= (ORDERS - 1) / RATE_LIMIT)
+        ]
+
+        calls_before = gateway.calls
+        rerun = json.loads(reconcile({'after_id': start_after_id})['body'])
+        checks.append(('повторный запуск трогает только pending', rerun['updated'] == 0
+                       and gateway.calls - calls_before == ORDERS - terminal))
+        
+        # 5 запросов/с и пачка 200: без учёта бюджета одна пачка заняла бы ORDERS - terminal запросов / 5 секунд
+        started_at = time.perf_counter()
+        limited = json.loads(reconcile({'after_id': start_after_id, 'batch_size': 200, 'rate_limit': 5,
+                                        'max_seconds': 1})['body'])
+        limited_elapsed = time.perf_counter() - started_at
+        print(f'max_seconds=1, 5 запросов/с: проверено {limited["checked"]} за {limited_elapsed:.2f} с')
+        checks.append(('запуск укладывается в max_seconds и продолжается по next_after_id',
+                       limited_elapsed < 1.5 and not limited['done'] and limited['checked'] <= 5))
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            timer_response = payment.handler({'messages': [{
+                'event_metadata': {'event_type': 'yandex.cloud.events.serverless.triggers.TimerMessage'},
+                'details': {'trigger_id': 'check', 'payload': json.dumps({'after_id': start_after_id})}
+            }]}, SimpleNamespace(request_id='check'))
+        timer_result = json.loads(timer_response['body'])
+        checks.append(('таймер-триггер запускает сверку без токена',
+                       timer_response['statusCode'] == 200 and timer_result['checked'] == ORDERS - terminal))
+    finally:
+        cur.execute(
+            "DELETE FROM order_event_deliveries WHERE event_id IN (SELECT id FROM order_events WHERE order_id = ANY(%s))",
+            (list(expected),)
+        )
+        cur.execute("DELETE FROM order_events WHERE order_id = ANY(%s)", (list(expected),))
+        cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (list(expected),))
+        conn.close()
+        gateway.stop()
+
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""Проверка резервирования остатков (product_stock) при параллельных заказах.
+
+Сначала пропускная способность: одинаковая пачка параллельных заказов товара без
+ограничений и товара с остатком, которого хватает на все заказы (все резервы идут
+в одну строку product_stock). Затем много одновременных заказов товара с маленьким
+остатком: продано должно быть ровно столько, сколько было, лишние заказы получают 409.
+В конце цикл отмена -> new -> отмена у одного заказа не должен менять остаток дважды,
+а оплата, пришедшая после отмены, не должна подтверждать заказ без резерва.
+
+Запуск (база с применёнными db_migrations):
+    DATABASE_URL=postgresql://... python scripts/check_stock_oversell.py --orders 300 --capacity 50 --threads 32
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from devserver import load_function  # noqa: E402
+from fake_yookassa import FakeYooKassa  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Проверка отсутствия перепродажи при параллельных заказах')
+    parser.add_argument('--orders', type=int, default=300)
+    parser.add_argument('--capacity', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+
+    gateway = FakeYooKassa().start()
+    os.environ['YUKASSA_API_URL'] = gateway.url
+    
+    orders = load_function('orders')
+    admin = load_function('admin')
+    payment = load_function('payment')
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    def create_product(capacity) -> int:
+        cur.execute(
+            "INSERT INTO products (name, price, is_available) VALUES ('Торт для проверки остатков', 1000, true) RETURNING id"
+        )
+        new_product_id = cur.fetchone()[0]
+        if capacity is not None:
+            cur.execute(
+                "INSERT INTO product_stock (product_id, capacity, remaining) VALUES (%s, %s, %s)",
+                (new_product_id, capacity, capacity)
+            )
+        return new_product_id
+
+    rng = random.Random(42)
+    quantities = [rng.choice((1, 1, 1, 2, 3)) for _ in range(args.orders)]
+
+    def run_checkouts(product_id: int) -> tuple:
+        """Все заказы параллельно: список (статус, количество) и время в секундах"""
+
+        def checkout(quantity: int) -> tuple:
+            body = {
+                'customer_name': 'Проверка',
+                'customer_phone': '+70000000000',
+                'delivery_method': 'pickup',
+                'items': [{'id': product_id, 'name': 'Торт', 'price': 1000, 'quantity': quantity}],
+                'total_amount': 1000 * quantity
+            }
+            response = orders.handler({'httpMethod': 'POST', 'body': json.dumps(body)},
+                                      SimpleNamespace(request_id='check'))
+            return response['statusCode'], quantity
+
+        # send_order_notification печатает по строке на заказ без SMTP
+        with contextlib.redirect_stdout(io.StringIO()):
+            started_at = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                results = list(pool.map(checkout, quantities))
+            return results, time.perf_counter() - started_at
+
+    def set_status(order_id: int, status: str) -> int:
+        response = admin.handler({
+            'httpMethod': 'PUT',
+            'queryStringParameters': {'action': 'order_status'},
+            'body': json.dumps({'order_id': order_id, 'status': status})
+        }, None)
+        return response['statusCode']
+
+    def remaining() -> int:
+        cur.execute("SELECT remaining FROM product_stock WHERE product_id = %s AND stock_date = CURRENT_DATE",
+                    (product_id,))
+        return cur.fetchone()[0]
+
+    checks = []
+    product_ids = []
+    try:
+        product_ids.append(create_product(None))
+        _, unlimited_elapsed = run_checkouts(product_ids[-1])
+        product_ids.append(create_product(sum(quantities)))
+        contended_results, contended_elapsed = run_checkouts(product_ids[-1])
+
+        print(f'{args.orders} заказов в {args.threads} потоков: без остатков {args.orders / unlimited_elapsed:.0f} заказов/с, '
+              f'с резервом одной строки {args.orders / contended_elapsed:.0f} заказов/с')
+        checks += [
+            ('с остатком, которого хватает, принимаются все заказы',
+             all(status == 200 for status, _ in contended_results)),
+            ('резерв не снижает пропускную способность больше чем вдвое', contended_elapsed <= 2 * unlimited_elapsed)
+        ]
+
+        product_id = create_product(args.capacity)
+        product_ids.append(product_id)
+        results, elapsed = run_checkouts(product_id)
+
+        accepted = [q for status, q in results if status == 200]
+        rejected = [q for status, q in results if status == 409]
+        other = [status for status, _ in results if status not in (200, 409)]
+
+        cur.execute("SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id = %s", (product_id,))
+        sold = cur.fetchone()[0]
+        left = remaining()
+
+        print(f'остаток {args.capacity}: {args.orders} заказов за {elapsed:.2f} с')
+        print(f'принято {len(accepted)} заказов ({sum(accepted)} шт.), отказано {len(rejected)}, '
+              f'других ответов {len(other)}; остаток {left} из {args.capacity}')
+
+        checks += [
+            ('нет ответов кроме 200 и 409', not other),
+            ('продано не больше остатка', sold <= args.capacity),
+            ('продано + остаток = ёмкость', sold + left == args.capacity),
+            ('сумма принятых заказов совпадает с order_items', sum(accepted) == sold),
+            ('отказы только когда остатка не хватало', all(q > left for q in rejected))
+        ]
+
+        cur.execute(
+            """
+            SELECT o.id, oi.quantity FROM orders o JOIN order_items oi ON oi.order_id = o.id
+            WHERE oi.product_id = %s ORDER BY o.id LIMIT 1
+            """,
+            (product_id,)
+        )
+        order_id, quantity = cur.fetchone()
+        before = remaining()
+
+        set_status(order_id, 'cancelled')
+        after_cancel = remaining()
+        set_status(order_id, 'cancelled')
+        after_second_cancel = remaining()
+        set_status(order_id, 'new')
+        after_restore = remaining()
+        set_status(order_id, 'cancelled')
+        after_recancel = remaining()
+
+        checks += [
+            ('отмена возвращает резерв', after_cancel == before + quantity),
+            ('повторная отмена ничего не возвращает', after_second_cancel == after_cancel),
+            ('возврат из отмены снова резервирует', after_restore == before),
+            ('отмена -> new -> отмена возвращает резерв один раз', after_recancel == before + quantity)
+        ]
+
+        cur.execute(
+            """
+            SELECT o.id FROM orders o JOIN order_items oi ON oi.order_id = o.id
+            WHERE oi.product_id = %s AND o.id <> %s ORDER BY o.id LIMIT 1
+            """,
+            (product_id, order_id)
+        )
+        paid_order_id = cur.fetchone()[0]
+        payment_id = f'oversell-{uuid.uuid4()}'
+        cur.execute(
+            "UPDATE orders SET payment_method = 'online', payment_status = 'pending', payment_id = %s WHERE id = %s",
+            (payment_id, paid_order_id)
+        )
+        gateway.add_payment(payment_id, paid_order_id, '1000.00')
+        set_status(paid_order_id, 'cancelled')
+        before_payment = remaining()
+        gateway.set_status(payment_id, 'succeeded')
+        payment.handler({'httpMethod': 'GET', 'queryStringParameters': {'payment_id': payment_id}},
+                        SimpleNamespace(request_id='check'))
+        cur.execute("SELECT status, payment_status FROM orders WHERE id = %s", (paid_order_id,))
+        checks.append(('оплата после отмены не подтверждает заказ и не трогает остаток',
+                       cur.fetchone() == ('cancelled', 'paid') and remaining() == before_payment))
+        
+        cur.execute("UPDATE product_stock SET remaining = 0 WHERE product_id = %s", (product_id,))
+        restore_status = set_status(order_id, 'new')
+        cur.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
+        checks.append(('без остатка заказ не возвращается из отмены (409)',
+                       restore_status == 409 and cur.fetchone()[0] == 'cancelled'))
+    finally:
+        cur.execute("SELECT DISTINCT order_id FROM order_items WHERE product_id = ANY(%s)", (product_ids,))
+        order_ids = [row[0] for row in cur.fetchall()]
+        cur.execute(
+            "DELETE FROM order_event_deliveries WHERE event_id IN (SELECT id FROM order_events WHERE order_id = ANY(%s))",
+            (order_ids,)
+        )
+        cur.execute("DELETE FROM order_events WHERE order_id = ANY(%s)", (order_ids,))
+        cur.execute("DELETE FROM order_items WHERE order_id = ANY(%s)", (order_ids,))
+        cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (order_ids,))
+        cur.execute("DELETE FROM product_stock WHERE product_id = ANY(%s)", (product_ids,))
+        cur.execute("DELETE FROM products WHERE id = ANY(%s)", (product_ids,))
+        conn.close()
+        gateway.stop()
+
+    for name, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
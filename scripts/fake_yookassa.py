@@ -0,0 +1,86 @@
+"""Локальная заглушка API ЮKassa для проверочных скриптов.
+
+Отвечает на GET /v3/payments/<id> и POST /v3/payments и считает запросы.
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeYooKassa:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.payments = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/v3'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def add_payment(self, payment_id: str, order_id: int, amount: str, status: str = 'pending'):
+        self.payments[payment_id] = {
+            'id': payment_id,
+            'status': status,
+            'paid': status == 'succeeded',
+            'amount': {'value': amount, 'currency': 'RUB'},
+            'metadata': {'order_id': order_id}
+        }
+
+    def set_status(self, payment_id: str, status: str):
+        self.payments[payment_id]['status'] = status
+        self.payments[payment_id]['paid'] = status == 'succeeded'
+
+    def _make_handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                gateway._count()
+                payment = gateway.payments.get(self.path.rsplit('/', 1)[-1])
+                if payment is None:
+                    self._reply(404, {'type': 'error', 'code': 'not_found'})
+                else:
+                    self._reply(200, payment)
+
+            def do_POST(self):
+                gateway._count()
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                payment_id = str(uuid.uuid4())
+                gateway.add_payment(payment_id, body.get('metadata', {}).get('order_id'),
+                                    body.get('amount', {}).get('value', '0.00'))
+                payment = dict(gateway.payments[payment_id])
+                payment['confirmation'] = {'type': 'redirect', 'confirmation_url': f'https://pay.example/{payment_id}'}
+                self._reply(200, payment)
+
+            def _reply(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _count(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
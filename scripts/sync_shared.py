@@ -0,0 +1,52 @@
+"""Копирование общих модулей из backend/_shared в каталоги облачных функций.
+
+Каждая функция деплоится только со своим каталогом и импортировать модуль из
+соседнего каталога не может, поэтому общий код лежит в каждой функции копией.
+Правится только исходник в backend/_shared, после правки копии обновляет этот скрипт.
+
+Запуск:
+    python scripts/sync_shared.py          # обновить копии
+    python scripts/sync_shared.py --check  # код возврата 1, если какая-то копия отличается от исходника
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+SHARED_DIR = os.path.join(BACKEND_DIR, '_shared')
+
+# Модуль -> функции, в которые он копируется
+SHARED_MODULES = {
+    'http_api.py': ('admin', 'orders', 'orders-get', 'payment'),
+    'order_events.py': ('admin', 'orders', 'payment'),
+    'perf_sampling.py': ('admin', 'orders', 'orders-get', 'payment')
+}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Синхронизация общих модулей функций')
+    parser.add_argument('--check', action='store_true', help='только проверить, что копии совпадают с исходником')
+    args = parser.parse_args()
+
+    stale = []
+    for module, functions in SHARED_MODULES.items():
+        source = os.path.join(SHARED_DIR, module)
+        for function_name in functions:
+            copy = os.path.join(BACKEND_DIR, function_name, module)
+            if os.path.exists(copy) and filecmp.cmp(source, copy, shallow=False):
+                continue
+            stale.append(os.path.relpath(copy, os.path.dirname(BACKEND_DIR)))
+            if not args.check:
+                shutil.copyfile(source, copy)
+
+    for path in stale:
+        print(f"{'отличается от исходника' if args.check else 'обновлён'}: {path}")
+
+    return 1 if args.check and stale else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())